@@ -0,0 +1,385 @@
+"""
+Microbenchmarks of the Python side of inigo_py.
+
+A stub of the native library (benchmarks/stub.c) is compiled with the local C compiler and loaded
+through INIGO_LIB_PATH, so the suite runs offline without an Inigo token. It measures the
+per-request overhead of Query and of the Flask/Django middlewares across header counts, body
+sizes and rewrite/block ratios. Middleware results have a matching baseline (wrapped app alone)
+so the overhead can be read directly. The scaling benchmark measures the throughput of concurrent
+threads against one native instance and against a pool of them (INIGO 'INSTANCES'), the stub
+serializing the calls of an instance like a library holding a per-instance lock would.
+
+usage:
+    python benchmarks/run.py [--quick] [--filter NAME] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stub.c')
+
+HEADER_COUNTS = (0, 16, 64)
+BODY_SIZES = (256, 16 * 1024, 256 * 1024)
+# threads of the scaling benchmark, and time (us) spent by the stub in each process_request
+THREADS = (1, 2, 4, 8, 16, 32)
+STUB_WORK_US = 200
+
+# share of requests (out of 100) which are blocked / rewritten by the stub
+MIXES = {
+    'passthrough': (0, 0),
+    'mixed': (10, 10),
+    'rewrite': (0, 50),
+    'block': (50, 0),
+}
+
+RESPONSE = b'{"data":{"hero":{"name":"R2-D2","friends":[{"name":"Luke Skywalker"},{"name":"Han Solo"}]}}}'
+
+
+def build_stub(build_dir):
+    library = os.path.join(build_dir, 'inigo-stub' + ('.dylib' if sys.platform == 'darwin' else '.so'))
+    subprocess.check_call([os.environ.get('CC', 'cc'), '-shared', '-fPIC', '-O2', '-pthread', '-o', library, STUB])
+    return library
+
+
+def make_bodies(size, mix):
+    # 100 request bodies of ~size bytes, blocked and rewritten ones first
+    block, rewrite = MIXES[mix]
+
+    bodies = []
+    for i in range(100):
+        marker = ''
+        if i < block:
+            marker = ' __bench_block'
+        elif i < block + rewrite:
+            marker = ' __bench_rewrite'
+
+        payload = {
+            'query': 'query Hero($episode: Episode) { hero(episode: $episode) { name friends { name } } }' + marker,
+            'operationName': 'Hero',
+            'variables': {'episode': 'JEDI', 'padding': ''},
+        }
+        padding = max(size - len(json.dumps(payload)), 0)
+        payload['variables']['padding'] = 'x' * padding
+        bodies.append(json.dumps(payload).encode('utf-8'))
+
+    return bodies
+
+
+def make_environ_headers(count):
+    headers = {
+        'HTTP_HOST': 'localhost',
+        'HTTP_ACCEPT': 'application/json',
+        'CONTENT_TYPE': 'application/json',
+    }
+    for i in range(count):
+        headers[f'HTTP_X_BENCH_{ i }'] = 'v' * 64
+
+    return headers
+
+
+def measure(fn, requests, iterations, warmup):
+    for i in range(warmup):
+        fn(requests[i % len(requests)])
+
+    samples = []
+    for i in range(iterations):
+        request = requests[i % len(requests)]
+        start = time.perf_counter_ns()
+        fn(request)
+        samples.append(time.perf_counter_ns() - start)
+
+    samples.sort()
+    total = sum(samples)
+
+    return {
+        'iterations': iterations,
+        'mean_us': total / iterations / 1000,
+        'p50_us': samples[iterations // 2] / 1000,
+        'p90_us': samples[int(iterations * 0.9)] / 1000,
+        'p99_us': samples[min(int(iterations * 0.99), iterations - 1)] / 1000,
+        'ops_per_sec': iterations / (total / 1e9) if total else 0.0,
+    }
+
+
+def measure_threads(fn, requests, threads, iterations, warmup):
+    # iterations split over concurrent threads, ops_per_sec is the aggregate throughput
+    per_thread = max(iterations // threads, 1)
+    barrier = threading.Barrier(threads + 1)
+    samples = [[] for _ in range(threads)]
+
+    def worker(n):
+        for i in range(warmup):
+            fn(requests[i % len(requests)])
+
+        barrier.wait()
+        for i in range(per_thread):
+            request = requests[i % len(requests)]
+            start = time.perf_counter_ns()
+            fn(request)
+            samples[n].append(time.perf_counter_ns() - start)
+        barrier.wait()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+
+    barrier.wait()
+    start = time.perf_counter_ns()
+    barrier.wait()
+    elapsed = time.perf_counter_ns() - start
+
+    for t in workers:
+        t.join()
+
+    samples = sorted(sample for thread_samples in samples for sample in thread_samples)
+    count = len(samples)
+
+    return {
+        'iterations': count,
+        'mean_us': sum(samples) / count / 1000,
+        'p50_us': samples[count // 2] / 1000,
+        'p90_us': samples[int(count * 0.9)] / 1000,
+        'p99_us': samples[min(int(count * 0.99), count - 1)] / 1000,
+        'ops_per_sec': count / (elapsed / 1e9) if elapsed else 0.0,
+    }
+
+
+def cases(quick):
+    if quick:
+        return [(16, 16 * 1024, 'passthrough'), (16, 16 * 1024, 'mixed')]
+
+    result = []
+    for headers in HEADER_COUNTS:
+        for size in BODY_SIZES:
+            for mix in MIXES:
+                result.append((headers, size, mix))
+    return result
+
+
+def bench_query(quick, iterations, warmup):
+    import ctypes
+
+    from inigo_py import ffi
+    from inigo_py.codec import get_codec
+    from inigo_py.headers import HeaderEncoder
+    from inigo_py.query import Query
+
+    c = ffi.Config()
+    instance = ffi.create(ctypes.byref(c))
+    encoder = HeaderEncoder(codec=get_codec())
+
+    for headers, size, mix in cases(quick):
+        headers_json = encoder.from_environ(make_environ_headers(headers))
+
+        def run(body):
+            # the handle of a blocked request is released on exit, like in the middlewares
+            with Query(instance, body) as q:
+                decision = q.process_request(headers_json)
+                if decision.is_blocked:
+                    return decision.body()
+                if decision.is_rewritten:
+                    decision.request
+                return q.process_response(RESPONSE)
+
+        yield 'query', {'headers': headers, 'body': size, 'mix': mix}, measure(run, make_bodies(size, mix), iterations, warmup)
+
+
+def bench_scaling(quick, iterations, warmup):
+    import ctypes
+
+    from inigo_py import ffi
+    from inigo_py.codec import get_codec
+    from inigo_py.headers import HeaderEncoder
+    from inigo_py.instance import new_instance
+    from inigo_py.query import Query
+
+    backend = ffi.load()
+    ffi.library.bench_set_work.argtypes = [ctypes.c_long]
+    ffi.library.bench_set_work(STUB_WORK_US)
+    encoder = HeaderEncoder(codec=get_codec())
+    headers_json = encoder.from_environ(make_environ_headers(16))
+    bodies = make_bodies(1024, 'passthrough')
+
+    try:
+        for threads in ((1, 4, 16) if quick else THREADS):
+            for pool in sorted({1, threads}):
+                for checkout in (('thread',) if pool == 1 else ('thread', 'least_busy')):
+                    instance = new_instance(backend, ffi.Config(), {'SIZE': pool, 'CHECKOUT': checkout})
+
+                    def run(body):
+                        with Query(instance, body, backend=backend) as q:
+                            q.process_request(headers_json)
+                            q.process_response(RESPONSE)
+
+                    params = {'threads': threads, 'instances': pool, 'checkout': checkout}
+                    yield 'scaling', params, measure_threads(run, bodies, threads, iterations, warmup // threads + 1)
+    finally:
+        ffi.library.bench_set_work(0)
+
+
+def wsgi_app(environ, start_response):
+    environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+    start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(RESPONSE)))])
+    return [RESPONSE]
+
+
+def bench_flask(quick, iterations, warmup):
+    try:
+        from inigo_py.flask import Middleware
+    except ImportError:
+        print('flask is not installed, skipping flask benchmarks', file=sys.stderr)
+        return
+
+    app = types.SimpleNamespace(wsgi_app=wsgi_app, config={'INIGO': {'TOKEN': 'benchmark'}})
+    middleware = Middleware(app)
+
+    def start_response(status, headers, exc_info=None):
+        return None
+
+    for headers, size, mix in cases(quick):
+        base = dict(make_environ_headers(headers), REQUEST_METHOD='POST', PATH_INFO='/graphql', QUERY_STRING='')
+
+        def environ(body):
+            return dict(base, CONTENT_LENGTH=str(len(body)), **{'wsgi.input': BytesIO(body)})
+
+        def run_baseline(body):
+            b''.join(wsgi_app(environ(body), start_response))
+
+        def run(body):
+            b''.join(middleware(environ(body), start_response))
+
+        params = {'headers': headers, 'body': size, 'mix': mix}
+        bodies = make_bodies(size, mix)
+        yield 'flask-baseline', params, measure(run_baseline, bodies, iterations, warmup)
+        yield 'flask', params, measure(run, bodies, iterations, warmup)
+
+
+def bench_django(quick, iterations, warmup):
+    try:
+        import django
+        from django.conf import settings
+    except ImportError:
+        print('django is not installed, skipping django benchmarks', file=sys.stderr)
+        return
+
+    if not settings.configured:
+        settings.configure(DEBUG=False, SECRET_KEY='benchmark', ALLOWED_HOSTS=['*'], INIGO={'TOKEN': 'benchmark'})
+        django.setup()
+
+    from django.core.handlers.wsgi import WSGIRequest
+    from django.http import HttpResponse
+
+    from inigo_py.django import Middleware
+
+    def get_response(request):
+        request.body
+        return HttpResponse(RESPONSE, content_type='application/json')
+
+    middleware = Middleware(get_response)
+
+    for headers, size, mix in cases(quick):
+        base = dict(make_environ_headers(headers), REQUEST_METHOD='POST', PATH_INFO='/graphql', QUERY_STRING='')
+
+        def request(body):
+            return WSGIRequest(dict(base, CONTENT_LENGTH=str(len(body)), **{'wsgi.input': BytesIO(body)}))
+
+        def run_baseline(body):
+            get_response(request(body)).content
+
+        def run(body):
+            middleware(request(body)).content
+
+        params = {'headers': headers, 'body': size, 'mix': mix}
+        bodies = make_bodies(size, mix)
+        yield 'django-baseline', params, measure(run_baseline, bodies, iterations, warmup)
+        yield 'django', params, measure(run, bodies, iterations, warmup)
+
+
+BENCHMARKS = {
+    'query': bench_query,
+    'flask': bench_flask,
+    'django': bench_django,
+    'scaling': bench_scaling,
+}
+
+
+def key(name, params):
+    # stable result id, used to compare runs
+    return name + '/' + ','.join(f'{ k }={ v }' for k, v in params.items())
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)['results']
+
+    print(f"\n{ 'benchmark':<60} { 'baseline us':>12} { 'current us':>12} { 'change':>8}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['mean_us']
+        after = result['mean_us']
+        change = (after - before) / before * 100 if before else 0.0
+        print(f'{ name:<60} { before:>12.2f} { after:>12.2f} { change:>+7.1f}%')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='inigo_py microbenchmarks')
+    parser.add_argument('--quick', action='store_true', help='run a reduced set of cases')
+    parser.add_argument('--filter', action='append', choices=list(BENCHMARKS), help='benchmarks to run, all by default')
+    parser.add_argument('--iterations', type=int, default=None)
+    parser.add_argument('--output', help='write results as json')
+    parser.add_argument('--compare', help='results json of a previous run to compare with')
+    args = parser.parse_args()
+
+    iterations = args.iterations or (500 if args.quick else 2000)
+    warmup = max(iterations // 10, 10)
+
+    with tempfile.TemporaryDirectory() as build_dir:
+        os.environ['INIGO_LIB_PATH'] = build_stub(build_dir)
+        sys.path.insert(0, ROOT)
+
+        import inigo_py
+
+        results = {}
+        print(f"{ 'benchmark':<60} { 'mean us':>10} { 'p50 us':>10} { 'p99 us':>10} { 'ops/s':>10}")
+        for name in args.filter or BENCHMARKS:
+            for bench, params, result in BENCHMARKS[name](args.quick, iterations, warmup):
+                result = dict(result, benchmark=bench, params=params)
+                results[key(bench, params)] = result
+                print(f"{ key(bench, params):<60} { result['mean_us']:>10.2f} { result['p50_us']:>10.2f} { result['p99_us']:>10.2f} { result['ops_per_sec']:>10.0f}")
+
+    output = {
+        'meta': {
+            'inigo_py': inigo_py.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'quick': args.quick,
+            'iterations': iterations,
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+// Stub of the inigo shared library used by the benchmarks.
+//
+// Implements the ABI bound in inigo_py/ffi.py without doing any real work, so the benchmarks
+// measure the Python side only. Decisions are driven by markers in the request:
+//   "__bench_block"   - request is blocked, output holds a GraphQL error response
+//   "__bench_rewrite" - query is rewritten, status holds the new query
+// every other request passes through. process_response returns a copy of its input.
+//
+// bench_set_work(us) makes process_request take that long while holding a per-instance lock,
+// emulating a library which serializes the calls of an instance (scaling benchmark).
+
+#define _GNU_SOURCE
+
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <pthread.h>
+#include <time.h>
+
+typedef struct {
+    bool debug;
+    char *name;
+    char *service;
+    char *token;
+    char *schema;
+    char *runtime;
+    char *egress_url;
+    uint64_t gateway;
+    bool disable_response_data;
+} Config;
+
+static const char BLOCKED[] = "{\"data\":null,\"errors\":[{\"message\":\"blocked by stub\"}]}";
+static const char REWRITTEN[] = "{\"query\":\"{ rewritten }\",\"operationName\":null,\"variables\":null}";
+
+static uint64_t instances = 0;
+static uint64_t handles = 0;
+
+#define LOCKS 64
+static pthread_mutex_t locks[LOCKS];
+static pthread_once_t locks_once = PTHREAD_ONCE_INIT;
+static long work_us = 0;
+
+static void init_locks(void) {
+    for (int i = 0; i < LOCKS; i++) {
+        pthread_mutex_init(&locks[i], NULL);
+    }
+}
+
+void bench_set_work(long us) {
+    pthread_once(&locks_once, init_locks);
+    work_us = us;
+}
+
+static void work(uint64_t instance) {
+    struct timespec ts = {work_us / 1000000, (work_us % 1000000) * 1000};
+
+    pthread_mutex_lock(&locks[instance % LOCKS]);
+    nanosleep(&ts, NULL);
+    pthread_mutex_unlock(&locks[instance % LOCKS]);
+}
+
+static char *copy(const char *src, int len) {
+    char *dst = malloc(len + 1);
+    memcpy(dst, src, len);
+    dst[len] = 0;
+    return dst;
+}
+
+static bool contains(const char *haystack, int len, const char *needle) {
+    return len > 0 && memmem(haystack, len, needle, strlen(needle)) != NULL;
+}
+
+uint64_t create(Config *config) {
+    return __atomic_add_fetch(&instances, 1, __ATOMIC_SEQ_CST);
+}
+
+uint64_t process_request(uint64_t instance,
+                         char *header, int header_len,
+                         char *input, int input_len,
+                         char **output, int *output_len,
+                         char **status, int *status_len) {
+    *output = NULL;
+    *output_len = 0;
+    *status = NULL;
+    *status_len = 0;
+
+    if (work_us > 0) {
+        work(instance);
+    }
+
+    if (contains(input, input_len, "__bench_block")) {
+        *output = copy(BLOCKED, sizeof(BLOCKED) - 1);
+        *output_len = sizeof(BLOCKED) - 1;
+    } else if (contains(input, input_len, "__bench_rewrite")) {
+        *status = copy(REWRITTEN, sizeof(REWRITTEN) - 1);
+        *status_len = sizeof(REWRITTEN) - 1;
+    }
+
+    return __atomic_add_fetch(&handles, 1, __ATOMIC_SEQ_CST);
+}
+
+void process_response(uint64_t instance, uint64_t handle,
+                      char *input, int input_len,
+                      char **output, int *output_len) {
+    *output = copy(input, input_len);
+    *output_len = input_len;
+}
+
+bool update_schema(uint64_t instance, char *schema) {
+    return true;
+}
+
+const char *get_version(void) {
+    return "{\"version\":\"benchmark-stub\"}";
+}
+
+void disposeHandle(uint64_t handle) {
+}
+
+void disposeMemory(void *ptr) {
+    free(ptr);
+}
+
+const char *check_lasterror(void) {
+    return NULL;
+}
@@ -1,11 +1,22 @@
 import pathlib
 
-from .ffi import get_version
-from .query import Query
-
 __all__ = [
     'get_version',
     'Query'
 ]
 
-__version__ = (pathlib.Path(__file__).parent.resolve() / "VERSION").read_text(encoding="utf-8").strip()
+
+def __getattr__(name):
+    # PEP 562, keeps 'import inigo_py' cheap: nothing is loaded until it is used
+    if name == 'Query':
+        from .query import Query
+        return Query
+
+    if name == 'get_version':
+        from .ffi import get_version
+        return get_version
+
+    if name == '__version__':
+        return (pathlib.Path(__file__).parent.resolve() / "VERSION").read_text(encoding="utf-8").strip()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
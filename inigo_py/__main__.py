@@ -0,0 +1,54 @@
+"""
+usage:
+    python -m inigo_py schema <dotted.path.to.schema> --cache-dir <dir>
+    python -m inigo_py schema <dotted.path.to.schema> --output schema.graphql
+
+Renders a Graphene schema once, at build time, into the INIGO 'SCHEMA_CACHE' directory (or a
+plain SDL file usable as 'SCHEMA_PATH'), so workers do not render it on every start.
+"""
+import argparse
+import os
+import sys
+
+
+def build_schema(args):
+    from . import schema
+
+    if os.environ.get('DJANGO_SETTINGS_MODULE'):
+        # graphene-django schemas need the app registry
+        import django
+        django.setup()
+
+    if args.output:
+        data = schema.render(args.schema)
+        with open(args.output, 'wb') as f:
+            f.write(data)
+        print(args.output)
+
+    if args.cache_dir:
+        print(schema.build(args.schema, args.cache_dir))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m inigo_py')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_schema = commands.add_parser('schema', help='precompute the schema SDL')
+    parser_schema.add_argument('schema', help='dotted path to the Graphene schema, e.g. myapp.schema.schema')
+    parser_schema.add_argument('--cache-dir', help='INIGO SCHEMA_CACHE directory to populate')
+    parser_schema.add_argument('--output', help='write the SDL to this file')
+    parser_schema.set_defaults(func=build_schema)
+
+    args = parser.parse_args(argv)
+    if args.command == 'schema' and not (args.cache_dir or args.output):
+        parser.error('schema: --cache-dir or --output is required')
+
+    # the schema module is imported relative to the working directory, like the application
+    if '' not in sys.path and os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import os
+import re
+
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+from .utils import fork_safe_lock, replace_query_param, write_atomic
+
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+NOT_FOUND = {
+    'errors': [{'message': 'PersistedQueryNotFound', 'extensions': {'code': 'PERSISTED_QUERY_NOT_FOUND'}}],
+}
+HASH_MISMATCH = {
+    'errors': [{'message': 'provided sha does not match query', 'extensions': {'code': 'PERSISTED_QUERY_HASH_MISMATCH'}}],
+}
+MALFORMED = {
+    'errors': [{'message': 'persisted query must have a string query', 'extensions': {'code': 'BAD_REQUEST'}}],
+}
+
+
+class PersistedQueries:
+    # Automatic persisted queries (extensions.persistedQuery.sha256Hash), opt-in with INIGO 'APQ':
+    #   SIZE      - max number of queries kept in memory, 1024 by default
+    #   PATH      - directory shared by the workers of a host, queries registered by one are found by all
+    #   MAX_FILES - max number of query files in PATH, 10000 by default
+    #   MAX_BYTES - max total size of the query files in PATH, 64 MiB by default
+    #
+    # Any client can register queries, the directory is trimmed (least recently used files first)
+    # every TRIM_EVERY files written by a process, so it may go over the limits by that much per worker.
+    #
+    # Hashes are resolved to the full query before Inigo sees the request, the app gets the full
+    # query too. An unknown hash is answered with PersistedQueryNotFound, the client then sends the
+    # query along with its hash and it is registered.
+    TRIM_EVERY = 64
+
+    def __init__(self, settings=None):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        self.size = settings.get('SIZE', 1024)
+        self.path = settings.get('PATH')
+        self.max_files = settings.get('MAX_FILES', 10000)
+        self.max_bytes = settings.get('MAX_BYTES', 64 * 1024 * 1024)
+        self.written = 0
+
+        self.entries = OrderedDict()
+        self.lock = fork_safe_lock(self)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sha256):
+        with self.lock:
+            query = self.entries.get(sha256)
+            if query is not None:
+                self.entries.move_to_end(sha256)
+                self.hits += 1
+                return query
+
+        query = self.read(sha256)
+
+        with self.lock:
+            if query is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        self.remember(sha256, query)
+        return query
+
+    def put(self, sha256, query):
+        if self.remember(sha256, query) and self.path:
+            path = os.path.join(self.path, sha256 + '.graphql')
+            if not os.path.exists(path):
+                try:
+                    write_atomic(path, query.encode('utf-8'))
+                except OSError as err:
+                    print(f"INIGO: persisted query { path } can not be written: { err }")
+                    return
+
+                with self.lock:
+                    self.written += 1
+                    trim = self.written % self.TRIM_EVERY == 1
+                if trim:
+                    self.trim()
+
+    def trim(self):
+        # removes the least recently used files until the directory is within MAX_FILES and MAX_BYTES
+        files = []
+        try:
+            with os.scandir(self.path) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.graphql'):
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        files.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            return
+
+        count = len(files)
+        size = sum(file_size for _, file_size, _ in files)
+
+        files.sort()
+        for _, file_size, path in files:
+            if count <= self.max_files and size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # removed by another worker
+                pass
+            count -= 1
+            size -= file_size
+
+    def remember(self, sha256, query):
+        # returns whether the query is new to this process
+        with self.lock:
+            if sha256 in self.entries:
+                self.entries.move_to_end(sha256)
+                return False
+
+            self.entries[sha256] = query
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+        return True
+
+    def read(self, sha256):
+        if not self.path:
+            return None
+
+        path = os.path.join(self.path, sha256 + '.graphql')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+
+        # files are shared, only trusted when they still match their name
+        if hashlib.sha256(data).hexdigest() != sha256:
+            return None
+
+        try:
+            # recently used, kept by trim()
+            os.utime(path)
+        except OSError:
+            pass
+
+        return data.decode('utf-8')
+
+    def resolve(self, operation):
+        # fills in the query of an APQ operation (dict), returns an error response when it can not be
+        extensions = operation.get('extensions')
+        if not isinstance(extensions, dict) or not isinstance(extensions.get('persistedQuery'), dict):
+            return None
+
+        sha256 = extensions['persistedQuery'].get('sha256Hash')
+        if not isinstance(sha256, str):
+            return None
+
+        sha256 = sha256.lower()
+        if not HASH_RE.match(sha256):
+            return HASH_MISMATCH
+
+        query = operation.get('query')
+        if query is not None and not isinstance(query, str):
+            return MALFORMED
+
+        if query:
+            if hashlib.sha256(query.encode('utf-8')).hexdigest() != sha256:
+                return HASH_MISMATCH
+            self.put(sha256, query)
+            return None
+
+        query = self.get(sha256)
+        if query is None:
+            return NOT_FOUND
+
+        operation['query'] = query
+        return None
+
+    def resolve_body(self, body, codec):
+        # POST body (an operation or a batch of them), returns (body, error). For a batch error is a
+        # list with the error response of every operation which can not be resolved (None for the
+        # others), to be answered in place by the Batch while the rest is forwarded. Bodies not
+        # mentioning persistedQuery are returned as is without being decoded.
+        if b'persistedQuery' not in body:
+            return body, None
+
+        try:
+            payload = codec.loads(body)
+        except ValueError:
+            return body, None
+
+        operations = payload if isinstance(payload, list) else [payload]
+        errors = [None] * len(operations)
+
+        changed = False
+        for i, operation in enumerate(operations):
+            if not isinstance(operation, dict):
+                continue
+
+            query = operation.get('query')
+            errors[i] = self.resolve(operation)
+            changed = changed or operation.get('query') is not query
+
+        if isinstance(payload, list):
+            error = errors if any(errors) else None
+        elif errors[0] is not None:
+            return body, errors[0]
+        else:
+            error = None
+
+        if not changed:
+            return body, error
+
+        return codec.dumps(payload), error
+
+    def resolve_query_string(self, query_string, codec):
+        # GET request, extensions is a json encoded parameter, returns (query_string, error)
+        if 'persistedQuery' not in query_string:
+            return query_string, None
+
+        params = parse_qs(query_string)
+        try:
+            extensions = codec.loads(params.get('extensions', ['{}'])[0])
+        except ValueError:
+            return query_string, None
+
+        operation = {'query': params.get('query', [''])[0], 'extensions': extensions}
+        error = self.resolve(operation)
+        if error is not None:
+            return query_string, error
+
+        if operation['query'] != params.get('query', [''])[0]:
+            query_string = replace_query_param(query_string, 'query', operation['query'])
+
+        return query_string, None
+
+    async def resolve_body_async(self, body, codec, executor=None):
+        # with PATH the lookups read and write files, run them off the event loop
+        if not self.path:
+            return self.resolve_body(body, codec)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.resolve_body, body, codec)
+
+    async def resolve_query_string_async(self, query_string, codec, executor=None):
+        if not self.path:
+            return self.resolve_query_string(query_string, codec)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.resolve_query_string, query_string, codec)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,5 @@
+from .middleware import Middleware
+
+__all__ = [
+    'Middleware'
+]
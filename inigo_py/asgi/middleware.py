@@ -0,0 +1,238 @@
+import time
+
+from urllib.parse import parse_qs
+
+from inigo_py.batch import Batch, new_query
+from inigo_py.middleware import BaseMiddleware
+from inigo_py.utils import replace_query_param
+
+class Middleware(BaseMiddleware):
+    def __init__(self, app, settings=None):
+        self.app = app
+
+        super().__init__(settings, 'asgi', async_mode=True)
+
+    async def __call__(self, scope, receive, send):
+        # ignore execution if Inigo is not initialized, or it is not a http request (lifespan, websocket)
+        if not self.instance or scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        # 'path' guard -> /graphql
+        if scope['path'] != self.path:
+            return await self.app(scope, receive, send)
+
+        request_method = scope['method']
+
+        # graphiql request
+        if request_method == 'GET' and ("text/html" in header(scope['headers'], b'accept', '*/*')):
+            return await self.app(scope, receive, send)
+
+        # support only POST and GET requests
+        if request_method != 'POST' and request_method != 'GET':
+            return await self.app(scope, receive, send)
+
+        # parse request
+        g_req: bytes = b''
+        # error responses of batch operations with an unknown persisted query
+        apq_errors = None
+        if request_method == "POST":
+            g_req = await read_body(receive)
+
+            if self.apq is not None:
+                # persisted query hashes are replaced by the full query, for Inigo and the app
+                body, error = await self.apq.resolve_body_async(g_req, self.codec, self.executor)
+                if isinstance(error, list):
+                    apq_errors = error
+                elif error is not None:
+                    return await self.respond(error, send)
+                if body is not g_req:
+                    g_req = body
+                    scope = dict(scope, headers=replace_header(scope['headers'], b'content-length', str(len(g_req)).encode('latin-1')))
+        elif request_method == "GET":
+            if self.apq is not None:
+                query_string, error = await self.apq.resolve_query_string_async(scope['query_string'].decode('latin-1'), self.codec, self.executor)
+                if error is not None:
+                    return await self.respond(error, send)
+                scope = dict(scope, query_string=query_string.encode('latin-1'))
+
+            # Returns a dictionary in which the values are lists
+            query_params = parse_qs(scope['query_string'].decode('latin-1'))
+            data = {
+                'query': query_params.get('query', [''])[0],
+                'operationName': query_params.get('operationName', [''])[0],
+                'variables': query_params.get('variables', [''])[0],
+            }
+            g_req = self.codec.dumps(data)
+
+        body = g_req
+        body_sent = False
+
+        async def receive_replay():
+            # the body was consumed by the middleware, replay it to the nested app
+            nonlocal body_sent
+            if request_method == 'POST' and not body_sent:
+                body_sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        # Inigo is bypassed while the LATENCY_BUDGET breaker is open
+        if self.breaker is not None and not self.breaker.allow():
+            return await self.app(scope, receive_replay, send)
+
+        start = time.perf_counter()
+
+        cache = self.select_cache(g_req)
+
+        # the native handle is released on every path, including the app raising
+        with new_query(self.instance, g_req, self.codec, cache, self.backend, apq_errors) as q:
+            # inigo: process request
+            decision = await self.process_request_async(q, self.headers(scope['headers']), self.identity(scope['headers'], cache))
+            if decision is None:
+                return await self.app(scope, receive_replay, send)
+
+            # introspection query
+            if decision.is_blocked:
+                return await self.respond(decision.body(), send, self.observe(q, decision, start))
+
+            # modify query if required
+            if decision.is_rewritten:
+                if request_method == 'GET':
+                    # only the query parameter is replaced, the rest of the query string is left as is
+                    req = decision.request
+                    query_string = replace_query_param(scope['query_string'].decode('latin-1'), 'query', req.get('query'))
+                    scope = dict(scope, query_string=query_string.encode('latin-1'))
+                elif request_method == 'POST':
+                    if isinstance(q, Batch):
+                        body = q.body()
+                    else:
+                        req = decision.request
+                        try:
+                            payload = self.codec.loads(body)
+                        except ValueError:
+                            payload = {}
+                        payload.update({
+                            'query': req.get('query'),
+                            'operationName': req.get('operationName'),
+                            'variables': req.get('variables'),
+                        })
+                        body = self.codec.dumps(payload)
+                    scope = dict(scope, headers=replace_header(scope['headers'], b'content-length', str(len(body)).encode('latin-1')))
+
+            inner_start = None
+            inner_body = []
+            passthrough = False
+
+            async def send_collector(message):
+                # collects the inner response, to be modified before sending to client
+                nonlocal inner_start, passthrough
+                if passthrough:
+                    await send(message)
+                    return
+
+                if message['type'] == 'http.response.start':
+                    if not self.processable(message.get('headers', []), q):
+                        # non json (event streams, multipart @defer, downloads) and cached decision responses
+                        # are not inspected by Inigo, they are sent to the client untouched as they come
+                        passthrough = True
+                        q.dispose()
+                        timing = self.observe(q, decision, start, time.perf_counter() - app_start)
+                        if timing is not None:
+                            message = dict(message, headers=list(message.get('headers', [])) + [(b'server-timing', timing.encode('latin-1'))])
+                        await send(message)
+                        return
+
+                    inner_start = message
+                    return
+
+                if message['type'] == 'http.response.body':
+                    inner_body.append(message.get('body', b''))
+                    if message.get('more_body', False):
+                        return
+
+                    app_duration = time.perf_counter() - app_start
+
+                    # inigo: process response, unless the decision came from the cache or it is not sampled
+                    response = b"".join(inner_body)
+                    headers = inner_start.get('headers', [])
+                    encoding = header(headers, b'content-encoding', None)
+                    if isinstance(q, Batch) and q.partial and not self.encodings.supports(encoding):
+                        # blocked operations can not be merged into a response in an unknown coding
+                        response = q.unmapped()
+                        headers = [(key, value) for key, value in headers if key.lower() != b'content-encoding']
+                        headers = replace_header(headers, b'content-type', b'application/json')
+                    elif q.handle != 0 and self.sampled(q, decision, len(response)):
+                        response = await self.encodings.process_response_async(q, response, encoding, self.executor)
+
+                    headers = replace_header(headers, b'content-length', str(len(response)).encode('latin-1'))
+                    timing = self.observe(q, decision, start, app_duration)
+                    if timing is not None:
+                        headers.append((b'server-timing', timing.encode('latin-1')))
+
+                    await send(dict(inner_start, headers=headers))
+                    await send({'type': 'http.response.body', 'body': response, 'more_body': False})
+                    return
+
+                await send(message)
+
+            # forward to request handler
+            app_start = time.perf_counter()
+            await self.app(scope, receive_replay, send_collector)
+
+    def processable(self, headers, q):
+        if isinstance(q, Batch) and q.partial:
+            # blocked operations are merged into the app response whatever its type
+            return True
+
+        content_type = header(headers, b'content-type', None)
+        if content_type is not None and 'json' not in content_type.lower():
+            return False
+
+        return q.handle != 0
+
+    def identity(self, raw_headers, cache):
+        # scope headers are raw (name, value) pairs instead of a WSGI environ
+        if cache is None:
+            return ()
+        return cache.identity_asgi(raw_headers)
+
+    def headers(self, raw_headers):
+        return self.header_encoder.from_asgi(raw_headers)
+
+    async def respond(self, data, send, timing=None):
+        body = self.response_body(data)
+
+        headers = [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ]
+        if timing is not None:
+            # Server-Timing of answers made by Inigo, see observe
+            headers.append((b'server-timing', timing.encode('latin-1')))
+
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            # client disconnected before sending the whole body
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+
+    return b"".join(chunks)
+
+
+def header(headers, name, default=''):
+    for key, value in headers:
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return default
+
+
+def replace_header(headers, name, value):
+    return [(k, v) for k, v in headers if k.lower() != name] + [(name, value)]
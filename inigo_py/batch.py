@@ -0,0 +1,213 @@
+import asyncio
+import re
+
+from .codec import get_codec
+from .query import Decision, Query, graphql_response
+
+BATCH_RE = re.compile(rb'\s*\[')
+
+# result of a forwarded operation when the app response can not be mapped back to the operations
+UNMAPPED = {
+    'data': None,
+    'errors': [{'message': 'batch response can not be mapped to its operations'}],
+}
+
+
+def is_batch(body):
+    # a batch is a json array of operations, checked without decoding or copying the body
+    return BATCH_RE.match(body) is not None
+
+
+def new_query(instance, request, codec=None, cache=None, backend=None, errors=None):
+    # Batch for a non empty json array body, Query for everything else. errors are the answers of
+    # batch operations which do not go through Inigo, see PersistedQueries.resolve_body
+    if is_batch(request):
+        try:
+            batch = Batch(instance, request, codec, cache, backend, errors)
+        except ValueError:
+            batch = None
+
+        if batch is not None and batch.operations:
+            return batch
+
+    return Query(instance, request, codec, cache, backend)
+
+
+class Batch:
+    # Batched GraphQL request (json array body). Every operation goes through Inigo on its own,
+    # blocked ones are answered directly and left out of the batch forwarded to the app,
+    # the app response is split back to the operations and reassembled in the original order.
+    def __init__(self, instance, request, codec=None, cache=None, backend=None, errors=None):
+        self.codec = codec or get_codec()
+        self.request = request
+
+        self.operations = self.codec.loads(request)
+        if not isinstance(self.operations, list):
+            raise ValueError('batch request must be a json array')
+
+        # error responses answering operations in place (unknown persisted queries), None for the others
+        self.errors = errors or [None] * len(self.operations)
+        self.queries = [Query(instance, self.codec.dumps(operation), self.codec, cache, backend) for operation in self.operations]
+
+        self.decisions = []
+        # indexes of the operations forwarded to the app
+        self.forwarded = []
+
+        self.detached = False
+
+    # measurements of the native calls, summed over the operations
+    @property
+    def cached(self):
+        return all(q.cached for q in self.queries)
+
+    @property
+    def request_duration(self):
+        return sum(q.request_duration for q in self.queries)
+
+    @property
+    def response_duration(self):
+        return sum(q.response_duration for q in self.queries)
+
+    @property
+    def bytes_in(self):
+        return sum(q.bytes_in for q in self.queries)
+
+    @property
+    def bytes_out(self):
+        return sum(q.bytes_out for q in self.queries)
+
+    @property
+    def partial(self):
+        # some operations are answered by Inigo and the others by the app, the app response alone is
+        # not the batch response and has to be merged, it is never passed through as is
+        return len(self.forwarded) != len(self.queries)
+
+    @property
+    def handle(self):
+        # non zero while the app response still has to go through process_response
+        if len(self.forwarded) != len(self.queries):
+            return 1
+        return 1 if any(q.handle for q in self.queries) else 0
+
+    def process_request(self, headers, identity=()):
+        self.decisions = []
+        for q, error in zip(self.queries, self.errors):
+            if error is not None:
+                # answered like a blocked operation, without a native call
+                self.decisions.append(Decision(self.codec.dumps(error), b'', self.codec))
+            else:
+                self.decisions.append(q.process_request(headers, identity))
+        self.forwarded = [i for i, decision in enumerate(self.decisions) if not decision.is_blocked]
+
+        # blocked operations never get a response from the app
+        for q, decision in zip(self.queries, self.decisions):
+            if decision.is_blocked:
+                q.dispose()
+
+        return BatchDecision(self)
+
+    def body(self):
+        # request body forwarded to the app: blocked operations removed, rewritten ones replaced
+        operations = []
+        for i in self.forwarded:
+            operation = self.operations[i]
+            decision = self.decisions[i]
+            if decision.is_rewritten:
+                req = decision.request
+                operation = dict(operation) if isinstance(operation, dict) else {}
+                operation.update({
+                    'query': req.get('query'),
+                    'operationName': req.get('operationName'),
+                    'variables': req.get('variables'),
+                })
+            operations.append(operation)
+
+        return self.codec.dumps(operations)
+
+    def process_response(self, resp_body):
+        try:
+            results = self.codec.loads(resp_body)
+        except ValueError:
+            results = None
+
+        if not isinstance(results, list) or len(results) != len(self.forwarded):
+            # app response can not be mapped back to the operations, passed through as is unless
+            # blocked operations have to be part of it
+            if self.partial:
+                return self.unmapped()
+            self.dispose()
+            return resp_body
+
+        for n, i in enumerate(self.forwarded):
+            q = self.queries[i]
+            if q.handle != 0:
+                results[n] = self.codec.loads(q.process_response(self.codec.dumps(results[n])))
+
+        return self.merge(results)
+
+    def merge(self, results):
+        # blocked answers and the results of the forwarded operations, in the original order
+        merged = [None] * len(self.queries)
+        for i, decision in enumerate(self.decisions):
+            if decision.is_blocked:
+                merged[i] = graphql_response(decision.response)
+
+        for result, i in zip(results, self.forwarded):
+            merged[i] = result
+
+        return self.codec.dumps(merged)
+
+    def unmapped(self):
+        # batch response when the app response can not be merged (unknown encoding, streamed or not
+        # a list of results): blocked operations keep their answer, forwarded ones get an error
+        self.dispose()
+        return self.merge([UNMAPPED] * len(self.forwarded))
+
+    def dispose(self):
+        for q in self.queries:
+            q.dispose()
+
+    def detach(self):
+        # see Query.detach
+        self.detached = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.detached:
+            self.dispose()
+
+    async def process_request_async(self, headers, executor=None, identity=()):
+        # ffi calls are blocking, run them off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_request, headers, identity)
+
+    async def process_response_async(self, resp_body, executor=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_response, resp_body)
+
+
+class BatchDecision:
+    # Decision counterpart for a whole batch
+    def __init__(self, batch):
+        self.batch = batch
+
+    @property
+    def is_blocked(self):
+        # every operation is answered by Inigo, the app is not called
+        return not self.batch.forwarded
+
+    @property
+    def is_rewritten(self):
+        # forwarded body differs from the original one
+        return any(decision.is_blocked or decision.is_rewritten for decision in self.batch.decisions)
+
+    @property
+    def response(self):
+        return [graphql_response(decision.response) for decision in self.batch.decisions]
+
+    def body(self):
+        # the operations are answered in one json array
+        return b'[' + b','.join(decision.body() for decision in self.batch.decisions) + b']'
+
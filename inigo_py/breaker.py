@@ -0,0 +1,193 @@
+import asyncio
+import concurrent.futures
+import time
+
+from collections import deque
+
+from .utils import fork_safe_lock
+
+
+class CircuitBreaker:
+    # Latency budget of the process_request calls, opt-in with INIGO 'LATENCY_BUDGET':
+    #   DEADLINE  - seconds a request waits for Inigo before it bypasses it, no deadline by default
+    #   BUDGET    - calls slower than this (seconds) count as slow, 0.05 by default
+    #   WINDOW    - number of recent calls tracked, 100 by default
+    #   MIN_CALLS - calls in the window before the breaker can open, 20 by default
+    #   THRESHOLD - share of slow or failed calls in the window opening the breaker, 0.5 by default
+    #   COOLDOWN  - seconds the breaker stays open before a probe request goes through, 5 by default
+    #   PROBE_TIMEOUT - seconds a probe has to report back before the breaker opens again, COOLDOWN by default
+    #
+    # Inigo fails open: while the breaker is open, and for calls past the deadline or failing,
+    # requests go to the app as if the middleware was not there. A native call can not be
+    # interrupted, one past its deadline completes in the background and its handle is released.
+    # After the cooldown a single probe request goes through Inigo, the breaker closes when it is
+    # within budget and opens again otherwise. A probe answered from the DECISION_CACHE says nothing
+    # about the library, the next request becomes the probe.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, settings=None):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        self.deadline = settings.get('DEADLINE')
+        self.budget = settings.get('BUDGET', 0.05)
+        self.min_calls = settings.get('MIN_CALLS', 20)
+        self.threshold = settings.get('THRESHOLD', 0.5)
+        self.cooldown = settings.get('COOLDOWN', 5.0)
+        self.probe_timeout = settings.get('PROBE_TIMEOUT', self.cooldown)
+
+        # True for slow or failed calls
+        self.window = deque(maxlen=settings.get('WINDOW', 100))
+        self.bad = 0
+
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self.lock = fork_safe_lock(self)
+
+        self.counters = {
+            'opened': 0,
+            'bypassed': 0,
+            'deadline_exceeded': 0,
+            'failed': 0,
+            'probe_timeouts': 0,
+        }
+
+    def allow(self):
+        # whether the request goes through Inigo
+        if self.state == self.CLOSED:
+            return True
+
+        with self.lock:
+            now = time.monotonic()
+
+            if self.state == self.HALF_OPEN and now - self.probe_started >= self.probe_timeout:
+                # the probe never reported back (e.g. the request failed before reaching Inigo),
+                # counted as a failed one, its cooldown starts when it timed out
+                self.state = self.OPEN
+                self.opened_at = self.probe_started + self.probe_timeout
+                self.counters['probe_timeouts'] += 1
+
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                # this request is the probe
+                self.state = self.HALF_OPEN
+                self.probe_started = now
+                return True
+
+            if self.state == self.CLOSED:
+                return True
+
+            self.counters['bypassed'] += 1
+            return False
+
+    def record(self, duration, failed=False):
+        bad = failed or duration > self.budget
+
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if bad:
+                    self.open()
+                else:
+                    self.state = self.CLOSED
+                    self.window.clear()
+                    self.bad = 0
+                return
+
+            if len(self.window) == self.window.maxlen and self.window[0]:
+                self.bad -= 1
+            self.window.append(bad)
+            self.bad += bad
+
+            if self.state == self.CLOSED and len(self.window) >= self.min_calls and self.bad >= self.threshold * len(self.window):
+                self.open()
+
+    def open(self):
+        # called with the lock held
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.counters['opened'] += 1
+
+    def process_request(self, q, headers, identity=(), executor=None):
+        # q.process_request within the budget, None when Inigo is bypassed for this request
+        start = time.perf_counter()
+        try:
+            if self.deadline is None:
+                decision = q.process_request(headers, identity)
+            else:
+                future = executor.submit(q.process_request, headers, identity)
+                try:
+                    decision = future.result(timeout=self.deadline)
+                except concurrent.futures.TimeoutError:
+                    # a call still queued behind stuck ones never runs, a running one is cleaned up later
+                    if not future.cancel():
+                        q.detach()
+                        future.add_done_callback(dispose_late(q))
+                    return self.exceeded()
+        except Exception as err:
+            return self.failed(err, start)
+
+        return self.completed(q, decision, start)
+
+    async def process_request_async(self, q, headers, identity=(), executor=None):
+        start = time.perf_counter()
+        try:
+            if self.deadline is None:
+                loop = asyncio.get_running_loop()
+                decision = await loop.run_in_executor(executor, q.process_request, headers, identity)
+            else:
+                # the concurrent future is kept, an asyncio one reports being cancelled while the call still runs
+                future = executor.submit(q.process_request, headers, identity)
+                try:
+                    decision = await asyncio.wait_for(asyncio.wrap_future(future), self.deadline)
+                except asyncio.TimeoutError:
+                    if not future.cancel():
+                        q.detach()
+                        future.add_done_callback(dispose_late(q))
+                    return self.exceeded()
+        except Exception as err:
+            return self.failed(err, start)
+
+        return self.completed(q, decision, start)
+
+    def completed(self, q, decision, start):
+        # decisions from the DECISION_CACHE do not say anything about the library latency
+        if not q.cached:
+            self.record(time.perf_counter() - start)
+        elif self.state == self.HALF_OPEN:
+            self.skip_probe()
+        return decision
+
+    def skip_probe(self):
+        # the probe did not call the library, the next request probes instead
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic() - self.cooldown
+
+    def exceeded(self):
+        with self.lock:
+            self.counters['deadline_exceeded'] += 1
+        self.record(self.deadline, failed=True)
+        return None
+
+    def failed(self, err, start):
+        print(f"INIGO: request processing failed, Inigo is bypassed: { err }")
+        with self.lock:
+            self.counters['failed'] += 1
+        self.record(time.perf_counter() - start, failed=True)
+        return None
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, state=self.state, window=len(self.window), slow_or_failed=self.bad)
+
+
+def dispose_late(q):
+    # releases the handle of a call which completed after the request stopped waiting for it, the
+    # query is detached so this is the only place its handle is released
+    def done(future):
+        if not future.cancelled() and future.exception() is None:
+            q.dispose()
+    return done
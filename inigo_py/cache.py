@@ -0,0 +1,139 @@
+import hashlib
+import time
+
+from collections import OrderedDict
+
+from .headers import environ_key
+from .utils import fork_safe_lock
+
+
+class DecisionCache:
+    # Bounded LRU and TTL cache of process_request decisions, opt-in with INIGO 'DECISION_CACHE':
+    #   SIZE      - max number of cached decisions, 1024 by default
+    #   TTL       - seconds a decision stays valid, 10 by default (None for no expiry)
+    #   HEADERS   - identity headers that are part of the key, Authorization and Cookie by default
+    #   DECISIONS - kinds of decisions cached: 'blocked' by default, 'rewritten' too when listed
+    #
+    # Blocks are often per caller or time based (access control, rate limits), hence the identity
+    # headers and the short TTL. Requests served from the cache do not cross into the native library,
+    # so they get no response processing (analytics, response filtering) either: rewritten decisions
+    # are only cached when asked for, for rewrites whose responses need no Inigo processing.
+    # Requests passing through untouched are never cached.
+    HEADERS = ['Authorization', 'Cookie']
+
+    def __init__(self, settings=None):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        self.size = settings.get('SIZE', 1024)
+        self.ttl = settings.get('TTL', 10)
+
+        self.headers = list(settings.get('HEADERS', self.HEADERS) or [])
+        self.headers_environ = [environ_key(name) for name in self.headers]
+        self.headers_asgi = [name.lower().encode('latin-1') for name in self.headers]
+
+        decisions = settings.get('DECISIONS') or ['blocked']
+        self.cache_blocked = 'blocked' in decisions
+        self.cache_rewritten = 'rewritten' in decisions
+
+        self.entries = OrderedDict()
+        self.lock = fork_safe_lock(self)
+        # bumped by clear(), decisions made against an older schema are dropped by put()
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def identity_environ(self, environ):
+        return tuple(environ.get(key, '') for key in self.headers_environ)
+
+    def identity_asgi(self, raw_headers):
+        values = dict((key.lower(), value) for key, value in raw_headers)
+        return tuple(values.get(key, b'').decode('latin-1') for key in self.headers_asgi)
+
+    @staticmethod
+    def key(request, identity=()):
+        # the whole payload is hashed, not only query and operationName, rewrites return variables too
+        h = hashlib.blake2b(bytes(request), digest_size=16)
+        for value in identity:
+            h.update(b'\0')
+            h.update(value.encode('utf-8'))
+        return h.digest()
+
+    def cacheable(self, decision):
+        if decision.is_blocked:
+            return self.cache_blocked
+        if decision.is_rewritten:
+            return self.cache_rewritten
+        return False
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            decision, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return decision
+
+    def put(self, key, decision, generation=None):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+
+            self.entries[key] = (decision, expires)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class IntrospectionCache(DecisionCache):
+    # Introspection answers (requests mentioning __schema), opt-in with INIGO 'INTROSPECTION_CACHE',
+    # True or a dict:
+    #   SIZE    - max number of cached answers, 16 by default
+    #   TTL     - seconds an answer stays valid, 300 by default as Inigo may change whether
+    #             introspection is allowed
+    #   HEADERS - identity headers that are part of the key, Authorization and Cookie by default
+    #
+    # Whether introspection is allowed, and the schema it returns, may depend on the caller, answers
+    # are only shared between requests with the same identity headers. An empty HEADERS list shares
+    # them between all callers. Answers are kept serialized and sent without a native call or any
+    # json work. They belong to the schema they were made with, the cache is cleared when the schema
+    # is updated.
+    def __init__(self, settings=None):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        settings = dict({'SIZE': 16, 'TTL': 300, 'HEADERS': self.HEADERS}, **settings)
+        settings['DECISIONS'] = ['blocked']
+        super().__init__(settings)
+
+    @staticmethod
+    def matches(request):
+        return b'__schema' in bytes(request)
@@ -0,0 +1,72 @@
+import functools
+import json
+
+
+class Codec:
+    # loads accepts bytes, dumps returns bytes, so callers never encode/decode utf-8 themselves
+    def __init__(self, name, loads, dumps):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+
+def orjson_codec():
+    import orjson
+
+    return Codec('orjson', orjson.loads, orjson.dumps)
+
+
+def msgspec_codec():
+    import msgspec
+
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder()
+
+    def loads(data):
+        try:
+            return decoder.decode(data)
+        except msgspec.DecodeError as err:
+            # keep the json.loads contract, callers catch ValueError
+            raise ValueError(str(err)) from err
+
+    return Codec('msgspec', loads, encoder.encode)
+
+
+def ujson_codec():
+    import ujson
+
+    return Codec('ujson', ujson.loads, lambda obj: ujson.dumps(obj).encode('utf-8'))
+
+
+def json_codec():
+    return Codec('json', json.loads, lambda obj: json.dumps(obj).encode('utf-8'))
+
+
+# in order of preference when no backend is configured
+BACKENDS = {
+    'orjson': orjson_codec,
+    'msgspec': msgspec_codec,
+    'ujson': ujson_codec,
+    'json': json_codec,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_codec(name=None):
+    if name:
+        if name not in BACKENDS:
+            raise ValueError(f"unknown JSON_BACKEND '{ name }', expected one of: { ', '.join(BACKENDS) }")
+
+        try:
+            return BACKENDS[name]()
+        except ImportError:
+            print(f"INIGO: json backend '{ name }' is not installed, falling back to json")
+            return json_codec()
+
+    for backend in BACKENDS.values():
+        try:
+            return backend()
+        except ImportError:
+            continue
+
+    return json_codec()
@@ -1,156 +1,254 @@
-import ctypes
-import json
-import os
-import platform
-import re
+import asyncio
+import time
 
 from django.conf import settings
-from django.http import JsonResponse
-from django.http import HttpResponse
-from django.utils.module_loading import import_string
+from django.http import HttpResponse, QueryDict
 
-from inigo_py import ffi, Query
+from inigo_py.batch import Batch, new_query
+from inigo_py.middleware import BaseMiddleware
 
-class Middleware:
-    def __init__(self, get_response):
-        # save response processing fn
-        self.get_response = get_response
-
-        self.instance = 0
-
-        if ffi.library is None:
-            # library is not found, skip middleware initialization
-            return
-
-        # default values
-        self.path = '/graphql'
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:
+    # asgiref < 3.6
+    iscoroutinefunction = asyncio.iscoroutinefunction
 
-        c = ffi.Config()
-        c.disable_response_data = False
-        c.name = str.encode('inigo-py : django')
-        c.runtime = str.encode('python' + re.search(r'\d+\.\d+', platform.sys.version).group(0))
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
 
-        inigo_settings = {}
+class Middleware(BaseMiddleware):
+    sync_capable = True
+    async_capable = True
 
-        if hasattr(settings, 'INIGO'):
-            inigo_settings = settings.INIGO
-
-        if inigo_settings.get('ENABLE') is False:
-            return
-
-        # process Inigo settings
-        if inigo_settings.get('DEBUG'):
-            c.debug = inigo_settings.get('DEBUG')
-        else:
-            # use regular DEBUG setting if specific is not provided
-            if hasattr(settings, 'DEBUG'):
-                c.debug = settings.DEBUG
-
-        if inigo_settings.get('TOKEN'):
-            c.token = str.encode(inigo_settings.get('TOKEN'))
+    def __init__(self, get_response):
+        # save response processing fn
+        self.get_response = get_response
 
-        schema = None
-        if inigo_settings.get('GRAPHENE_SCHEMA'):
-            schema = import_string(inigo_settings.get('GRAPHENE_SCHEMA'))
-        elif inigo_settings.get('SCHEMA_PATH'):
-            if os.path.isfile(inigo_settings.get('SCHEMA_PATH')):
-                with open(inigo_settings.get('SCHEMA_PATH'), 'r') as f:
-                    schema = f.read()
-        elif hasattr(settings, 'GRAPHENE') and settings.GRAPHENE.get('SCHEMA'):
-            schema = import_string(settings.GRAPHENE.get('SCHEMA'))
+        # under ASGI the handler chain is async, serve it natively instead of through sync_to_async
+        self.async_mode = iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
 
-        if schema:
-            c.schema = str.encode(str(schema))
+        super().__init__(getattr(settings, 'INIGO', {}), 'django', getattr(settings, 'DEBUG', None),
+                         getattr(settings, 'GRAPHENE', {}).get('SCHEMA'), self.async_mode)
 
-        if inigo_settings.get('PATH'):
-            self.path = inigo_settings.get('PATH')
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
 
-        # create Inigo instance
-        self.instance = ffi.create(ctypes.byref(c))
+        # ignore execution if Inigo is not initialized or request is not a graphql one
+        if not self.intercepts(request):
+            return self.get_response(request)
 
-        error = ffi.check_lasterror()
-        if error:
-            print("INIGO: " + error.decode('utf-8'))
+        # persisted query hashes are replaced by the full query, for Inigo and the app
+        error = self.resolve_persisted(request)
+        apq_errors = error if isinstance(error, list) else None
+        if error is not None and apq_errors is None:
+            return self.respond(error)
 
-        if self.instance == 0:
-            print("INIGO: error, instance can not be created")
+        # Inigo is bypassed while the LATENCY_BUDGET breaker is open
+        if self.breaker is not None and not self.breaker.allow():
+            return self.get_response(request)
 
-    def __call__(self, request):
+        start = time.perf_counter()
+
+        g_req = self.request_body(request)
+        cache = self.select_cache(g_req)
+
+        # the native handle is released on every path, including the app raising
+        with new_query(self.instance, g_req, self.codec, cache, self.backend, apq_errors) as q:
+            # inigo: process request
+            decision = self.process_request(q, self.headers(request.META), self.identity(request.META, cache))
+            if decision is None:
+                return self.get_response(request)
+
+            # introspection query
+            if decision.is_blocked:
+                return self.timed(self.respond(decision.body()), q, decision, start)
+
+            # modify query if required
+            if decision.is_rewritten:
+                self.rewrite(request, q, decision)
+
+            # forward to request handler
+            app_start = time.perf_counter()
+            response = self.get_response(request)
+            app_duration = time.perf_counter() - app_start
+
+            if isinstance(q, Batch) and q.partial and (response.streaming or not self.encodings.supports(response.get('Content-Encoding'))):
+                # blocked operations can not be merged into a streamed response or one in an unknown coding
+                response.close()
+                return self.timed(self.respond(q.unmapped()), q, decision, start, app_duration)
+
+            # streaming, cached decision and unsampled responses are passed through as is
+            if response.streaming or q.handle == 0 or not self.sampled(q, decision, len(response.content)):
+                q.dispose()
+                return self.timed(response, q, decision, start, app_duration)
+
+            # inigo: process response
+            body = response.content
+            response = self.update_response(response, body, self.encodings.process_response(q, body, response.get('Content-Encoding')))
+            return self.timed(response, q, decision, start, app_duration)
+
+    async def __acall__(self, request):
+        # ignore execution if Inigo is not initialized or request is not a graphql one
+        if not self.intercepts(request):
+            return await self.get_response(request)
+
+        # persisted query hashes are replaced by the full query, for Inigo and the app
+        error = await self.resolve_persisted_async(request)
+        apq_errors = error if isinstance(error, list) else None
+        if error is not None and apq_errors is None:
+            return self.respond(error)
+
+        # Inigo is bypassed while the LATENCY_BUDGET breaker is open
+        if self.breaker is not None and not self.breaker.allow():
+            return await self.get_response(request)
+
+        start = time.perf_counter()
+
+        g_req = self.request_body(request)
+        cache = self.select_cache(g_req)
+
+        # the native handle is released on every path, including the app raising
+        with new_query(self.instance, g_req, self.codec, cache, self.backend, apq_errors) as q:
+            # inigo: process request
+            decision = await self.process_request_async(q, self.headers(request.META), self.identity(request.META, cache))
+            if decision is None:
+                return await self.get_response(request)
+
+            # introspection query
+            if decision.is_blocked:
+                return self.timed(self.respond(decision.body()), q, decision, start)
+
+            # modify query if required
+            if decision.is_rewritten:
+                self.rewrite(request, q, decision)
+
+            # forward to request handler
+            app_start = time.perf_counter()
+            response = await self.get_response(request)
+            app_duration = time.perf_counter() - app_start
+
+            if isinstance(q, Batch) and q.partial and (response.streaming or not self.encodings.supports(response.get('Content-Encoding'))):
+                # blocked operations can not be merged into a streamed response or one in an unknown coding
+                response.close()
+                return self.timed(self.respond(q.unmapped()), q, decision, start, app_duration)
+
+            # streaming, cached decision and unsampled responses are passed through as is
+            if response.streaming or q.handle == 0 or not self.sampled(q, decision, len(response.content)):
+                q.dispose()
+                return self.timed(response, q, decision, start, app_duration)
+
+            # inigo: process response
+            body = response.content
+            response = self.update_response(response, body, await self.encodings.process_response_async(q, body, response.get('Content-Encoding'), self.executor))
+            return self.timed(response, q, decision, start, app_duration)
+
+    def intercepts(self, request):
         # ignore execution if Inigo is not initialized
-        if self.instance == 0:
-            return self.get_response(request)
+        if not self.instance:
+            return False
 
         # 'path' guard -> /graphql
         if request.path != self.path:
-            return self.get_response(request)
+            return False
 
         # graphiql request
         if request.method == 'GET' and ("text/html" in request.META.get("HTTP_ACCEPT", "*/*")):
-            return self.get_response(request)
+            return False
 
         # support only POST and GET requests
         if request.method != 'POST' and request.method != 'GET':
-            return self.get_response(request)
+            return False
+
+        return True
 
+    def request_body(self, request):
         # parse request
         gReq: bytes = b''
         if request.method == "POST":
             # read request from body
             gReq = request.body
         elif request.method == "GET":
-            # read request from query param
-            gReq = str.encode(json.dumps({'query': request.GET.get('query')}))
-        q = Query(self.instance, gReq)
-
-        # inigo: process request
-        resp, req = q.process_request(self.headers(request))
-
-        # introspection query
-        if resp:
-            return self.respond(resp)
-
-        # modify query if required
-        if req:
-            if request.method == 'POST':
-                body = json.loads(request.body)
-                body.update({
-                    'query': req.get('query'),
-                    'operationName': req.get('operationName'),
-                    'variables': req.get('variables'),
-                })
-
-                request._body = str.encode(json.dumps(body))
-            elif request.method == 'GET':
-                params = request.GET.copy()
-                params.update({
-                    'query': req.get('query')
-                })
-                request.GET = params
-
-        # forward to request handler
-        response = self.get_response(request)
-
-        # inigo: process response
-        return HttpResponse(q.process_response(response.content), status=200, content_type='application/json')
-
-    @staticmethod
-    def headers(request):
-        headers = {}
-        for key, value in request.headers.items():
-            headers[key] = value.split(", ")
+            # read request from query params
+            gReq = self.codec.dumps({
+                'query': request.GET.get('query'),
+                'operationName': request.GET.get('operationName'),
+                'variables': request.GET.get('variables'),
+            })
+
+        return gReq
+
+    def resolve_persisted(self, request):
+        # returns the error response of an unknown or mismatching persisted query hash, a list of them
+        # for a batch, see PersistedQueries.resolve_body
+        if self.apq is None:
+            return None
+
+        if request.method == 'POST':
+            body, error = self.apq.resolve_body(request.body, self.codec)
+            if body is not request.body:
+                request._body = body
+            return error
+
+        query_string = request.META.get('QUERY_STRING', '')
+        resolved, error = self.apq.resolve_query_string(query_string, self.codec)
+        if resolved != query_string:
+            request.META['QUERY_STRING'] = resolved
+            request.GET = QueryDict(resolved)
+        return error
+
+    async def resolve_persisted_async(self, request):
+        # with APQ 'PATH' the lookups read and write files, run them off the event loop
+        if self.apq is None or not self.apq.path:
+            return self.resolve_persisted(request)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.resolve_persisted, request)
+
+    def rewrite(self, request, q, decision):
+        if isinstance(q, Batch):
+            request._body = q.body()
+            return
 
-        return str.encode(json.dumps(headers))
+        req = decision.request
+        if request.method == 'POST':
+            body = self.codec.loads(request.body)
+            body.update({
+                'query': req.get('query'),
+                'operationName': req.get('operationName'),
+                'variables': req.get('variables'),
+            })
+
+            request._body = self.codec.dumps(body)
+        elif request.method == 'GET':
+            params = request.GET.copy()
+            params.update({
+                'query': req.get('query')
+            })
+            request.GET = params
+
+    def timed(self, response, q, decision, start, app=0.0):
+        timing = self.observe(q, decision, start, app)
+        if timing is not None:
+            if response.has_header('Server-Timing'):
+                timing = response['Server-Timing'] + ', ' + timing
+            response['Server-Timing'] = timing
+
+        return response
 
     @staticmethod
-    def respond(data):
-        response = {
-            'data': data.get('data'),
-        }
+    def update_response(response, body, processed):
+        # keep the original response (status, headers, cookies), only replace content when Inigo changed it
+        if processed is None or processed is body or processed == body:
+            return response
 
-        if data.get('errors'):
-            response['errors'] = data.get('errors')
+        response.content = processed
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(processed))
 
-        if data.get('extensions'):
-            response['extensions'] = data.get('extensions')
+        return response
 
-        return JsonResponse(response, status=200)
+    def respond(self, data):
+        return HttpResponse(self.response_body(data), status=200, content_type='application/json')
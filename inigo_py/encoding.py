@@ -0,0 +1,108 @@
+import asyncio
+import zlib
+
+from .batch import Batch
+
+
+class ZlibCoding:
+    # gzip (wbits 31) and deflate (zlib wrapped, wbits 15) content codings
+    def __init__(self, wbits, level):
+        self.wbits = wbits
+        # compressor configured once, copied for every response
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def decode(self, data):
+        try:
+            return zlib.decompress(data, self.wbits)
+        except zlib.error:
+            if self.wbits != 15:
+                raise
+            # some servers send raw deflate streams
+            return zlib.decompress(data, -15)
+
+    def encode(self, data):
+        compressor = self.compressor.copy()
+        return compressor.compress(data) + compressor.flush()
+
+
+class BrotliCoding:
+    def __init__(self, brotli, quality):
+        self.brotli = brotli
+        self.quality = quality
+
+    def decode(self, data):
+        return self.brotli.decompress(data)
+
+    def encode(self, data):
+        return self.brotli.compress(data, quality=self.quality)
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        try:
+            import brotlicffi as brotli
+        except ImportError:
+            return None
+    return brotli
+
+
+class ContentEncodings:
+    # Content-Encoding aware response processing. A compressed response (a compression middleware
+    # running inside Inigo) is decoded for Inigo and encoded again only when Inigo modified it,
+    # otherwise the original bytes are sent as is. Compression levels are set with INIGO 'COMPRESSION',
+    # e.g. {'gzip': 6, 'deflate': 6, 'br': 4}. br needs the brotli (or brotlicffi) package, responses
+    # in a coding which can not be decoded are passed through without Inigo processing.
+    LEVELS = {'gzip': 6, 'deflate': 6, 'br': 4}
+
+    def __init__(self, settings=None):
+        levels = dict(self.LEVELS, **(settings or {}))
+
+        self.codings = {
+            'gzip': ZlibCoding(31, levels['gzip']),
+            'x-gzip': ZlibCoding(31, levels['gzip']),
+            'deflate': ZlibCoding(15, levels['deflate']),
+        }
+
+        brotli = brotli_module()
+        if brotli is not None:
+            self.codings['br'] = BrotliCoding(brotli, levels['br'])
+
+    def supports(self, encoding=None):
+        # whether responses in this coding can go through Inigo, partly blocked batches in any other
+        # one can not be merged and are answered with an error by the middlewares
+        encoding = (encoding or '').strip().lower()
+        return not encoding or encoding == 'identity' or encoding in self.codings
+
+    def process_response(self, q, body, encoding=None):
+        # q.process_response on the decoded body, returns the body to send
+        encoding = (encoding or '').strip().lower()
+        if not encoding or encoding == 'identity':
+            return q.process_response(body)
+
+        coding = self.codings.get(encoding)
+        if coding is None:
+            # unsupported or stacked codings (e.g. 'gzip, br')
+            q.dispose()
+            return body
+
+        try:
+            decoded = coding.decode(body)
+        except Exception:
+            if isinstance(q, Batch) and q.partial:
+                return coding.encode(q.unmapped())
+            q.dispose()
+            return body
+
+        processed = q.process_response(decoded)
+        if processed is None or processed is decoded or processed == decoded:
+            # unchanged, no need to compress it again
+            return body
+
+        return coding.encode(processed)
+
+    async def process_response_async(self, q, body, encoding=None, executor=None):
+        # decoding and encoding are cpu bound too, run them off the event loop with the ffi call
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_response, q, body, encoding)
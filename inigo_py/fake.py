@@ -0,0 +1,82 @@
+import itertools
+import json
+import random
+import time
+
+from .ffi import Backend
+from .utils import fork_safe_lock
+
+BLOCKED = b'{"data":null,"errors":[{"message":"blocked by inigo fake backend"}]}'
+
+
+class FakeBackend(Backend):
+    # In-process stand-in for the Inigo library, for load tests and CI without the shared library
+    # or a service token. Configured with INIGO 'FAKE':
+    #   REQUEST_LATENCY  - seconds spent in process_request
+    #   RESPONSE_LATENCY - seconds spent in process_response
+    #   BLOCK_RATE       - share of requests blocked (0..1)
+    #   REWRITE_RATE     - share of requests rewritten (0..1), the query is rewritten to itself
+    #   BLOCK            - requests containing any of these strings are always blocked
+    #   SEED             - random seed, for reproducible runs
+    def __init__(self, settings=None):
+        settings = settings or {}
+
+        self.request_latency = settings.get('REQUEST_LATENCY', 0.0)
+        self.response_latency = settings.get('RESPONSE_LATENCY', 0.0)
+        self.block_rate = settings.get('BLOCK_RATE', 0.0)
+        self.rewrite_rate = settings.get('REWRITE_RATE', 0.0)
+        self.block = [marker.encode('utf-8') for marker in settings.get('BLOCK') or []]
+
+        self.random = random.Random(settings.get('SEED'))
+        self.lock = fork_safe_lock(self)
+
+        self.instances = itertools.count(1)
+        self.handles = itertools.count(1)
+
+    def create(self, config):
+        return next(self.instances)
+
+    def process_request(self, instance, headers, request):
+        if self.request_latency:
+            time.sleep(self.request_latency)
+
+        request = bytes(request)
+
+        with self.lock:
+            roll = self.random.random()
+
+        handle = next(self.handles)
+
+        if roll < self.block_rate or any(marker in request for marker in self.block):
+            return handle, BLOCKED, b''
+
+        if roll < self.block_rate + self.rewrite_rate:
+            try:
+                payload = json.loads(request)
+            except ValueError:
+                payload = {}
+
+            if isinstance(payload, dict):
+                status = json.dumps({
+                    'query': payload.get('query'),
+                    'operationName': payload.get('operationName'),
+                    'variables': payload.get('variables'),
+                }).encode('utf-8')
+                return handle, b'', status
+
+        return handle, b'', b''
+
+    def process_response(self, instance, handle, response):
+        if self.response_latency:
+            time.sleep(self.response_latency)
+
+        return None
+
+    def update_schema(self, instance, schema):
+        return True
+
+    def dispose_handle(self, handle):
+        pass
+
+    def get_version(self):
+        return b'{"version":"fake"}'
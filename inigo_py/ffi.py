@@ -1,6 +1,9 @@
 import os
 import platform
 import ctypes
+import threading
+
+from .utils import fork_safe_lock
 
 def get_arch(system_name):
     machine = platform.machine().lower()
@@ -41,81 +44,326 @@ def get_ext(system_name):
 system = platform.system().lower()  # linux, windows, darwin
 filename = f'inigo-{ system }-{ get_arch(system) }{ get_ext(system) }'
 
-try:
-    library = ctypes.CDLL(os.path.join(os.path.dirname(__file__), 'lib', filename))
-
-    class Config(ctypes.Structure):
-        _fields_ = [
-            ('debug', ctypes.c_bool),
-            ('name', ctypes.c_char_p),
-            ('service', ctypes.c_char_p),
-            ('token', ctypes.c_char_p),
-            ('schema', ctypes.c_char_p),
-            ('runtime', ctypes.c_char_p),
-            ('egress_url', ctypes.c_char_p),
-            ('gateway', ctypes.c_uint64),
-            ('disable_response_data', ctypes.c_bool),
+class Config(ctypes.Structure):
+    _fields_ = [
+        ('debug', ctypes.c_bool),
+        ('name', ctypes.c_char_p),
+        ('service', ctypes.c_char_p),
+        ('token', ctypes.c_char_p),
+        ('schema', ctypes.c_char_p),
+        ('runtime', ctypes.c_char_p),
+        ('egress_url', ctypes.c_char_p),
+        ('gateway', ctypes.c_uint64),
+        ('disable_response_data', ctypes.c_bool),
+    ]
+
+
+class Accounting:
+    # Process wide count of native resources held by inigo_py: request handles not disposed yet and
+    # native buffers not handed back to disposeMemory. Both stay around the number of requests in
+    # flight, a steady growth is a leak. Pulled with ffi.accounting.snapshot().
+    KINDS = ('handles', 'buffers')
+
+    def __init__(self):
+        self.lock = fork_safe_lock(self)
+        self.live = dict.fromkeys(self.KINDS, 0)
+        self.total = dict.fromkeys(self.KINDS, 0)
+
+    def acquire(self, kind, n=1):
+        with self.lock:
+            self.live[kind] += n
+            self.total[kind] += n
+
+    def release(self, kind, n=1):
+        with self.lock:
+            self.live[kind] -= n
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'live_handles': self.live['handles'],
+                'live_buffers': self.live['buffers'],
+                'handles': self.total['handles'],
+                'buffers': self.total['buffers'],
+            }
+
+
+accounting = Accounting()
+
+
+class Backend:
+    # Interface between Query/middlewares and the Inigo library. CtypesBackend (the shared library)
+    # is the default, inigo_py.fake.FakeBackend simulates it in-process.
+    def create(self, config):
+        # config is a Config structure, returns the instance id (0 on failure)
+        raise NotImplementedError
+
+    def process_request(self, instance, headers, request):
+        # returns (handle, output, status): output is the response when Inigo answers the request
+        # itself (blocked, introspection), status the rewritten query; both empty bytes when unused
+        raise NotImplementedError
+
+    def process_response(self, instance, handle, response):
+        # returns the processed response, None when it is left unchanged
+        raise NotImplementedError
+
+    def update_schema(self, instance, schema):
+        # schema is the SDL (bytes, or the address of a NUL terminated copy), returns True when it is applied
+        raise NotImplementedError
+
+    def dispose_handle(self, handle):
+        raise NotImplementedError
+
+    def get_version(self):
+        raise NotImplementedError
+
+    def check_lasterror(self):
+        return None
+
+
+class CtypesBackend(Backend):
+    def __init__(self, library):
+        self.library = library
+
+        self.create_fn = library.create
+        self.create_fn.argtypes = [ctypes.POINTER(Config)]
+        self.create_fn.restype = ctypes.c_uint64
+
+        self.process_request_fn = library.process_request
+        self.process_request_fn.argtypes = [
+            ctypes.c_uint64,  # instance
+            ctypes.c_char_p, ctypes.c_int,  # header
+            ctypes.c_char_p, ctypes.c_int,  # input
+            # output buffers are read as void pointers: NULL checks without copying the string,
+            # and they are handed back to disposeMemory without a ctypes.cast
+            ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),  # output
+            ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),  # status
         ]
+        self.process_request_fn.restype = ctypes.c_uint64
 
-    create = library.create
-    create.argtypes = [ctypes.POINTER(Config)]
-    create.restype = ctypes.c_uint64
+        self.process_response_fn = library.process_response
+        self.process_response_fn.argtypes = [
+            ctypes.c_uint64,  # instance
+            ctypes.c_uint64,  # request handler
+            ctypes.POINTER(ctypes.c_char), ctypes.c_int,  # input
+            ctypes.POINTER(ctypes.c_void_p), ctypes.POINTER(ctypes.c_int),  # output
+        ]
+        self.process_response_fn.restype = None
 
+        # not exported by older versions of the library
+        self.update_schema_fn = getattr(library, 'update_schema', None)
+        if self.update_schema_fn is not None:
+            self.update_schema_fn.argtypes = [
+                ctypes.c_uint64,  # instance
+                ctypes.c_char_p  # input
+            ]
+            self.update_schema_fn.restype = ctypes.c_bool
 
-    process_request = library.process_request
-    process_request.argtypes = [
-        ctypes.c_uint64,  # instance
-        ctypes.c_char_p, ctypes.c_int,  # header
-        ctypes.c_char_p, ctypes.c_int,  # input
-        ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int),  # output
-        ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int),  # status
-    ]
-    process_request.restype = ctypes.c_uint64
+        self.get_version_fn = library.get_version
+        self.get_version_fn.argtypes = None
+        self.get_version_fn.restype = ctypes.c_char_p  # version
 
+        self.dispose_handle_fn = library.disposeHandle
+        self.dispose_handle_fn.argtypes = [
+            ctypes.c_uint64  # request handler
+        ]
+        self.dispose_handle_fn.restype = None
 
-    process_response = library.process_response
-    process_response.argtypes = [
-        ctypes.c_uint64,  # instance
-        ctypes.c_uint64,  # request handler
-        ctypes.POINTER(ctypes.c_char), ctypes.c_int,  # input
-        ctypes.POINTER(ctypes.c_char_p), ctypes.POINTER(ctypes.c_int),  # output
-    ]
-    process_response.restype = None
+        self.dispose_memory_fn = library.disposeMemory
+        self.dispose_memory_fn.argtypes = [
+            ctypes.c_void_p
+        ]
+        self.dispose_memory_fn.restype = None
 
+        self.check_lasterror_fn = library.check_lasterror
+        self.check_lasterror_fn.argtypes = None
+        self.check_lasterror_fn.restype = ctypes.c_char_p
 
-    # update_schema = library.update_schema
-    # update_schema.argtypes = [
-    #     ctypes.c_uint64,  # instance
-    #     ctypes.c_char_p  # input
-    # ]
-    # update_schema.restype = ctypes.c_bool
+    def create(self, config):
+        return self.create_fn(ctypes.byref(config))
 
+    def process_request(self, instance, headers, request):
+        headers, headers_len = as_buffer(headers)
+        request, request_len = as_buffer(request)
 
-    get_version = library.get_version
-    get_version.argtypes = None
-    get_version.restype = ctypes.c_char_p  # version
+        output_ptr = ctypes.c_void_p()
+        output_len = ctypes.c_int()
 
+        status_ptr = ctypes.c_void_p()
+        status_len = ctypes.c_int()
 
-    disposeHandle = library.disposeHandle
-    disposeHandle.argtypes = [
-        ctypes.c_uint64  # request handler
-    ]
-    disposeHandle.restype = None
+        handle = self.process_request_fn(instance,
+                                         headers, headers_len,
+                                         request, request_len,
+                                         ctypes.byref(output_ptr), ctypes.byref(output_len),
+                                         ctypes.byref(status_ptr), ctypes.byref(status_len))
 
+        buffers = (output_ptr.value is not None) + (status_ptr.value is not None)
+        if buffers:
+            accounting.acquire('buffers', buffers)
 
-    disposeMemory = library.disposeMemory
-    disposeMemory.argtypes = [
-        ctypes.c_void_p
-    ]
-    disposeMemory.restype = None
+        try:
+            # string_at copies exactly len bytes, without scanning for NUL first
+            output = ctypes.string_at(output_ptr, output_len.value) if output_len.value else b''
+            status = ctypes.string_at(status_ptr, status_len.value) if status_len.value else b''
+        finally:
+            # NULL outputs (nothing allocated) are not handed back
+            if output_ptr.value is not None:
+                self.dispose_memory_fn(output_ptr)
+            if status_ptr.value is not None:
+                self.dispose_memory_fn(status_ptr)
+            if buffers:
+                accounting.release('buffers', buffers)
+
+        return handle, output, status
+
+    def process_response(self, instance, handle, response):
+        body, body_len = as_buffer(response)
+
+        output_ptr = ctypes.c_void_p()
+        output_len = ctypes.c_int()
+
+        self.process_response_fn(
+            instance,
+            handle,
+            body, body_len,
+            ctypes.byref(output_ptr), ctypes.byref(output_len)
+        )
+
+        if output_ptr.value is None:
+            return None
+
+        accounting.acquire('buffers')
+        try:
+            output = None
+            if output_len.value:
+                output = ctypes.string_at(output_ptr, output_len.value)
+        finally:
+            self.dispose_memory_fn(output_ptr)
+            accounting.release('buffers')
 
+        return output
 
-    check_lasterror = library.check_lasterror
-    check_lasterror.argtypes = None
-    check_lasterror.restype = ctypes.c_char_p
-except Exception as err:
-    # Unable to open libc dynamic library
-    raise Exception(f"""
+    def update_schema(self, instance, schema):
+        if self.update_schema_fn is None:
+            return False
+
+        if isinstance(schema, int):
+            # address of a mapped schema cache file
+            schema = ctypes.c_char_p(schema)
+
+        return bool(self.update_schema_fn(instance, schema))
+
+    def dispose_handle(self, handle):
+        self.dispose_handle_fn(handle)
+
+    def get_version(self):
+        return self.get_version_fn()
+
+    def check_lasterror(self):
+        return self.check_lasterror_fn()
+
+
+def as_buffer(data):
+    # bytes are passed to the native side as is, writable buffers (bytearray, memoryview)
+    # are wrapped in place; only read-only or non-contiguous views have to be copied
+    if isinstance(data, bytes):
+        return data, len(data)
+
+    view = memoryview(data)
+    if view.readonly or not view.c_contiguous:
+        data = view.tobytes()
+        return data, len(data)
+
+    return (ctypes.c_char * view.nbytes).from_buffer(view), view.nbytes
+
+
+def get_backend(settings=None):
+    # backend selected with INIGO 'BACKEND': 'ctypes' (default), 'fake', a dotted path to a Backend
+    # class or a Backend instance. The fake one is configured with INIGO 'FAKE'.
+    settings = settings or {}
+    name = settings.get('BACKEND') or 'ctypes'
+
+    if isinstance(name, Backend):
+        return name
+
+    if name == 'ctypes':
+        return load()
+
+    if name == 'fake':
+        from .fake import FakeBackend
+        return FakeBackend(settings.get('FAKE'))
+
+    from .utils import import_string
+    return import_string(name)(settings)
+
+
+# INIGO_LIB_PATH overrides the bundled library, e.g. with a locally built one or the benchmark stub
+path = os.environ.get('INIGO_LIB_PATH') or os.path.join(os.path.dirname(__file__), 'lib', filename)
+
+# the library is loaded on first use (first middleware created), not at import time
+library = None
+backend = None
+load_error = None
+loaded = False
+load_lock = threading.Lock()
+
+# raw library functions, bound by CtypesBackend and resolved through __getattr__
+FUNCTIONS = {
+    'create': 'create_fn',
+    'process_request': 'process_request_fn',
+    'process_response': 'process_response_fn',
+    'disposeHandle': 'dispose_handle_fn',
+    'disposeMemory': 'dispose_memory_fn',
+    'check_lasterror': 'check_lasterror_fn',
+    'update_schema': 'update_schema_fn',
+}
+
+
+def load():
+    # loads the shared library once, returns the default backend or None when it is not available
+    global library, backend, load_error, loaded
+
+    if loaded:
+        return backend
+
+    with load_lock:
+        if loaded:
+            return backend
+
+        try:
+            library = ctypes.CDLL(path)
+            backend = CtypesBackend(library)
+        except Exception as err:
+            library = None
+            backend = None
+            load_error = error_message(err)
+            # Inigo is skipped (requests pass through) instead of failing the application
+            print("INIGO: " + load_error)
+
+        loaded = True
+
+    return backend
+
+
+def get_version():
+    if load() is None:
+        raise Exception(load_error)
+    return backend.get_version()
+
+
+def __getattr__(name):
+    # PEP 562, binds the raw library functions on first access
+    if name in FUNCTIONS:
+        if load() is None:
+            raise Exception(load_error)
+        return getattr(backend, FUNCTIONS[name])
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def error_message(err):
+    return f"""
         
           Unable to open inigo shared library. 
           
@@ -128,5 +376,4 @@ except Exception as err:
           uname:    { platform.uname().__str__() }
           arch:     { platform.architecture().__str__() }
           
-        """)
-
+        """
@@ -1,83 +1,29 @@
-import ctypes
-import json
-import os
-import sys
-import platform
-import re
-
-from importlib import import_module
+import itertools
+import time
+
 from io import BytesIO
 from urllib.parse import parse_qs
 
-from werkzeug.datastructures import EnvironHeaders
+from werkzeug.wsgi import ClosingIterator
 
-from inigo_py import ffi, Query
+from inigo_py.batch import Batch, new_query
+from inigo_py.middleware import BaseMiddleware
+from inigo_py.utils import replace_query_param
 
-class Middleware:
+class Middleware(BaseMiddleware):
     def __init__(self, app):
         self.app = app.wsgi_app
 
-        self.instance = 0
-
-        if ffi.library is None:
-            # library is not found, skip middleware initialization
-            return
-
-        # default values
-        self.path = '/graphql'
-
-        c = ffi.Config()
-        c.disable_response_data = False
-        c.name = str.encode('inigo-py : flask')
-        c.runtime = str.encode('python' + re.search(r'\d+\.\d+', platform.sys.version).group(0))
-
-        inigo_settings = {}
-        if 'INIGO' in app.config:
-            inigo_settings = app.config.get('INIGO')
-
-        if inigo_settings.get('ENABLE') is False:
-            return
-
-        # process Inigo settings
-        if inigo_settings.get('DEBUG'):
-            c.debug = inigo_settings.get('DEBUG')
-        else:
-            # use regular DEBUG setting if specific is not provided
-            if 'DEBUG' in app.config:
-                c.debug = app.config.get('DEBUG')
-
-        if inigo_settings.get('TOKEN'):
-            c.token = str.encode(inigo_settings.get('TOKEN'))
-
-        schema = None
-        if inigo_settings.get('GRAPHENE_SCHEMA'):
-            schema = import_string(inigo_settings.get('GRAPHENE_SCHEMA'))
-        elif inigo_settings.get('SCHEMA_PATH'):
-            if os.path.isfile(inigo_settings.get('SCHEMA_PATH')):
-                with open(inigo_settings.get('SCHEMA_PATH'), 'r') as f:
-                    schema = f.read()
-        elif 'GRAPHENE' in app.config and app.config.get('GRAPHENE').get('SCHEMA'):
-            schema = import_string(app.config.get('GRAPHENE').get('SCHEMA'))
-
-        if schema:
-            c.schema = str.encode(str(schema))
+        inigo_settings = app.config.get('INIGO') or {}
 
-        if inigo_settings.get('PATH'):
-            self.path = inigo_settings.get('PATH')
+        super().__init__(inigo_settings, 'flask', app.config.get('DEBUG'), (app.config.get('GRAPHENE') or {}).get('SCHEMA'))
 
-        # create Inigo instance
-        self.instance = ffi.create(ctypes.byref(c))
-
-        error = ffi.check_lasterror()
-        if error:
-            print("INIGO: " + error.decode('utf-8'))
-
-        if self.instance == 0:
-            print("INIGO: error, instance can not be created")
+        # responses above this size (bytes) are streamed to the client without being processed by Inigo
+        self.max_response_size = inigo_settings.get('MAX_RESPONSE_SIZE')
 
     def __call__(self, environ, start_response):
         # ignore execution if Inigo is not initialized
-        if self.instance == 0:
+        if not self.instance:
             return self.app(environ, start_response)
 
         # 'path' guard -> /graphql
@@ -96,18 +42,39 @@ class Middleware:
 
         # parse request
         g_req: bytes = b''
+        # error responses of batch operations with an unknown persisted query
+        apq_errors = None
         if request_method == "POST":
 
             # Get the request body from the environ as reading from global request object caches it.
+            # The body is read once, the nested app and the rewrite below reuse the same buffer.
             if environ.get('wsgi.input'):
                 content_length = environ.get('CONTENT_LENGTH')
                 if content_length == '-1':
                     g_req = environ.get('wsgi.input').read(-1)
                 else:
-                    g_req = environ.get('wsgi.input').read(int(content_length))
-                # reset request body for the nested app
+                    g_req = environ.get('wsgi.input').read(int(content_length or 0))
+
+                if self.apq is not None:
+                    # persisted query hashes are replaced by the full query, for Inigo and the app
+                    body, error = self.apq.resolve_body(g_req, self.codec)
+                    if isinstance(error, list):
+                        apq_errors = error
+                    elif error is not None:
+                        return self.respond(error, start_response)
+                    if body is not g_req:
+                        g_req = body
+                        environ['CONTENT_LENGTH'] = str(len(g_req))
+
+                # reset request body for the nested app, BytesIO shares the bytes until written to
                 environ['wsgi.input'] = BytesIO(g_req)
         elif request_method == "GET":
+            if self.apq is not None:
+                query_string, error = self.apq.resolve_query_string(environ.get('QUERY_STRING', ''), self.codec)
+                if error is not None:
+                    return self.respond(error, start_response)
+                environ['QUERY_STRING'] = query_string
+
             # Returns a dictionary in which the values are lists
             query_params = parse_qs(environ['QUERY_STRING'])
             data = {
@@ -115,117 +82,152 @@ class Middleware:
                 'operationName': query_params.get('operationName', [''])[0],
                 'variables': query_params.get('variables', [''])[0],
             }
-            g_req = str.encode(json.dumps(data))
-
-        q = Query(self.instance, g_req)
-
-        headers = dict(EnvironHeaders(environ).to_wsgi_list())
-
-        # inigo: process request
-        resp, req = q.process_request(self.headers(headers))
-
-        # introspection query
-        if resp:
-            return self.respond(resp, start_response)
-
-        # modify query if required
-        if req:
-            if request_method == 'GET':
-                query_params = parse_qs(environ['QUERY_STRING'])
-                query_params['query'] = req.get('query')
-                environ['QUERY_STRING'] = '&'.join([f"{k}={v[0]}" for k, v in query_params.items()])
-            elif request_method == 'POST':
-                content_length = int(environ.get('CONTENT_LENGTH', 0))
-                body = environ['wsgi.input'].read(content_length)
-                try:
-                    payload = json.loads(body)
-                except ValueError:
-                    payload = {}
-                payload.update({
-                    'query': req.get('query'),
-                    'operationName': req.get('operationName'),
-                    'variables': req.get('variables'),
-                })
-                payload_str = json.dumps(payload).encode('utf-8')
-                environ['wsgi.input'] = BytesIO(payload_str)
-                environ['CONTENT_LENGTH'] = str(len(payload_str))
-
-        inner_status = None
-        inner_headers = []
-        inner_exc_info = None
-
-        def start_response_collector(status, headers, exc_info=None):
-            # Just collects the inner response headers, to be modified before sending to client
-            nonlocal inner_status, inner_headers, inner_exc_info
-            inner_status = status
-            inner_headers = headers
-            inner_exc_info = exc_info
-            # Not calling start_response(), as we will modify the headers first.
-            return None
-
-        # forward to request handler
-        # populates the inner_* vars, as triggers inner call of the collector closure
-        response = self.app(environ, start_response_collector)
-
-        # inigo: process response
-        response = [q.process_response(b"".join(response))]
-        # removes Content-Length from original headers
-        inner_headers = [(key, value) for key, value in inner_headers if key != 'Content-Length']
-        start_response(inner_status, inner_headers, inner_exc_info)
-        return response
-
-    @staticmethod
-    def headers(headers_dict):
-        headers = {}
-        for key, value in headers_dict.items():
-            headers[key] = value.split(", ")
-
-        return str.encode(json.dumps(headers))
-
-    @staticmethod
-    def respond(data, start_response):
-        response = {
-            'data': data.get('data'),
-        }
-
-        if data.get('errors'):
-            response['errors'] = data.get('errors')
-
-        if data.get('extensions'):
-            response['extensions'] = data.get('extensions')
+            g_req = self.codec.dumps(data)
+
+        # Inigo is bypassed while the LATENCY_BUDGET breaker is open
+        if self.breaker is not None and not self.breaker.allow():
+            return self.app(environ, start_response)
 
+        start = time.perf_counter()
+
+        cache = self.select_cache(g_req)
+
+        # the native handle is released on every path, including the app raising
+        with new_query(self.instance, g_req, self.codec, cache, self.backend, apq_errors) as q:
+            # inigo: process request
+            decision = self.process_request(q, self.headers(environ), self.identity(environ, cache))
+            if decision is None:
+                return self.app(environ, start_response)
+
+            # introspection query
+            if decision.is_blocked:
+                return self.respond(decision.body(), start_response, self.observe(q, decision, start))
+
+            # modify query if required
+            if decision.is_rewritten:
+                if request_method == 'GET':
+                    # only the query parameter is replaced, the rest of the query string is left as is
+                    req = decision.request
+                    environ['QUERY_STRING'] = replace_query_param(environ['QUERY_STRING'], 'query', req.get('query'))
+                elif request_method == 'POST':
+                    if isinstance(q, Batch):
+                        payload_str = q.body()
+                    else:
+                        # the body is parsed at most once, only when Inigo modified the query
+                        req = decision.request
+                        try:
+                            payload = self.codec.loads(g_req)
+                        except ValueError:
+                            payload = {}
+                        payload.update({
+                            'query': req.get('query'),
+                            'operationName': req.get('operationName'),
+                            'variables': req.get('variables'),
+                        })
+                        payload_str = self.codec.dumps(payload)
+                    environ['wsgi.input'] = BytesIO(payload_str)
+                    environ['CONTENT_LENGTH'] = str(len(payload_str))
+
+            inner_status = None
+            inner_headers = []
+            inner_exc_info = None
+
+            def start_response_collector(status, headers, exc_info=None):
+                # Just collects the inner response headers, to be modified before sending to client
+                nonlocal inner_status, inner_headers, inner_exc_info
+                inner_status = status
+                inner_headers = headers
+                inner_exc_info = exc_info
+                # Not calling start_response(), as we will modify the headers first.
+                return None
+
+            # forward to request handler
+            # populates the inner_* vars, as triggers inner call of the collector closure
+            app_start = time.perf_counter()
+            response = self.app(environ, start_response_collector)
+
+            if isinstance(q, Batch) and q.partial and not self.encodings.supports(content_encoding(inner_headers)):
+                # blocked operations can not be merged into a response in an unknown coding
+                close(response)
+                return self.respond(q.unmapped(), start_response, self.observe(q, decision, start, time.perf_counter() - app_start))
+
+            # non json (file downloads, multipart), oversized, unsampled or cached decision responses are not
+            # inspected by Inigo, they are passed through as is and the server closes the original iterable
+            if q.handle == 0 or not self.processable(inner_headers, q, decision):
+                q.dispose()
+                start_response(inner_status, self.timed(inner_headers, q, decision, start, time.perf_counter() - app_start), inner_exc_info)
+                return response
+
+            # partly blocked batches are always buffered, the blocked answers are merged into them
+            partial = isinstance(q, Batch) and q.partial
+            chunks = []
+            size = 0
+            iterator = iter(response)
+            try:
+                for chunk in iterator:
+                    chunks.append(chunk)
+                    size += len(chunk)
+
+                    if self.max_response_size is not None and size > self.max_response_size and not partial:
+                        # too large to buffer, stream what was read so far and the rest as it comes
+                        q.dispose()
+                        start_response(inner_status, self.timed(inner_headers, q, decision, start, time.perf_counter() - app_start), inner_exc_info)
+                        return ClosingIterator(itertools.chain(chunks, iterator), getattr(response, 'close', None))
+            except BaseException:
+                close(response)
+                raise
+
+            close(response)
+            app_duration = time.perf_counter() - app_start
+
+            # inigo: process response
+            response = [self.encodings.process_response(q, b"".join(chunks), content_encoding(inner_headers))]
+            # removes Content-Length from original headers
+            inner_headers = [(key, value) for key, value in inner_headers if key != 'Content-Length']
+            start_response(inner_status, self.timed(inner_headers, q, decision, start, app_duration), inner_exc_info)
+            return response
+
+    def timed(self, headers, q, decision, start, app):
+        timing = self.observe(q, decision, start, app)
+        if timing is None:
+            return headers
+        return headers + [('Server-Timing', timing)]
+
+    def processable(self, headers, q, decision):
+        if isinstance(q, Batch) and q.partial:
+            # blocked operations are merged into the app response whatever its type or size
+            return True
+
+        size = None
+        for key, value in headers:
+            key = key.lower()
+            if key == 'content-type' and 'json' not in value.lower():
+                return False
+            if key == 'content-length' and value.isdigit():
+                size = int(value)
+                if self.max_response_size is not None and size > self.max_response_size:
+                    return False
+
+        return self.sampled(q, decision, size)
+
+    def respond(self, data, start_response, timing=None):
         status = "200 OK"
         headers = [("Content-type", "application/json")]
+        if timing is not None:
+            # Server-Timing of answers made by Inigo, see observe
+            headers.append(('Server-Timing', timing))
         start_response(status, headers)
 
-        return [json.dumps(response).encode("utf-8")]
-
-
-def cached_import(module_path, class_name):
-    # Check whether module is loaded and fully initialized.
-    if not (
-            (module := sys.modules.get(module_path))
-            and (spec := getattr(module, "__spec__", None))
-            and getattr(spec, "_initializing", False) is False
-    ):
-        module = import_module(module_path)
-    return getattr(module, class_name)
-
-
-def import_string(dotted_path):
-    """
-    Import a dotted module path and return the attribute/class designated by the
-    last name in the path. Raise ImportError if the import failed.
-    """
-    try:
-        module_path, class_name = dotted_path.rsplit(".", 1)
-    except ValueError as err:
-        raise ImportError("%s doesn't look like a module path" % dotted_path) from err
-
-    try:
-        return cached_import(module_path, class_name)
-    except AttributeError as err:
-        raise ImportError(
-            'Module "%s" does not define a "%s" attribute/class'
-            % (module_path, class_name)
-        ) from err
+        return [self.response_body(data)]
+
+
+def content_encoding(headers):
+    for key, value in headers:
+        if key.lower() == 'content-encoding':
+            return value
+    return None
+
+
+def close(response):
+    if hasattr(response, 'close'):
+        response.close()
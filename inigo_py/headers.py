@@ -0,0 +1,80 @@
+from .codec import get_codec
+
+# WSGI keeps these two without the HTTP_ prefix
+UNPREFIXED = {'CONTENT_TYPE': 'Content-Type', 'CONTENT_LENGTH': 'Content-Length'}
+
+
+class HeaderEncoder:
+    # Builds the headers json passed to process_request in a single pass over the request headers.
+    #
+    # settings (INIGO 'HEADERS'):
+    #   ALLOW - only these headers are forwarded to Inigo
+    #   DENY  - these headers are never forwarded (e.g. Cookie)
+    # names are case-insensitive, all headers are forwarded when nothing is configured.
+    def __init__(self, settings=None, codec=None):
+        settings = settings or {}
+
+        self.codec = codec or get_codec()
+
+        self.deny = frozenset(name.lower() for name in settings.get('DENY') or [])
+
+        # with an allowlist only the listed headers are looked up, instead of scanning all of them
+        self.allow_environ = None
+        self.allow_asgi = None
+        if settings.get('ALLOW') is not None:
+            allow = [name for name in settings.get('ALLOW') if name.lower() not in self.deny]
+            # environ key -> header name
+            self.allow_environ = {environ_key(name): name.title() for name in allow}
+            self.allow_asgi = frozenset(name.lower().encode('latin-1') for name in allow)
+
+    def from_environ(self, environ):
+        # WSGI environ or Django request.META
+        headers = {}
+
+        if self.allow_environ is not None:
+            for key, name in self.allow_environ.items():
+                value = environ.get(key)
+                if value:
+                    headers[name] = value.split(", ")
+
+            return self.codec.dumps(headers)
+
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                name = key[5:].replace('_', '-').title()
+            elif key in UNPREFIXED:
+                if not value:
+                    continue
+                name = UNPREFIXED[key]
+            else:
+                continue
+
+            if self.deny and name.lower() in self.deny:
+                continue
+
+            headers[name] = value.split(", ")
+
+        return self.codec.dumps(headers)
+
+    def from_asgi(self, raw_headers):
+        # ASGI scope headers, a list of (name, value) byte pairs which can repeat
+        headers = {}
+
+        for key, value in raw_headers:
+            key = key.lower()
+            if self.allow_asgi is not None:
+                if key not in self.allow_asgi:
+                    continue
+            elif self.deny and key.decode('latin-1') in self.deny:
+                continue
+
+            headers.setdefault(key.decode('latin-1').title(), []).extend(value.decode('latin-1').split(", "))
+
+        return self.codec.dumps(headers)
+
+
+def environ_key(name):
+    key = name.upper().replace('-', '_')
+    if key in UNPREFIXED:
+        return key
+    return 'HTTP_' + key
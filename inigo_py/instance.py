@@ -0,0 +1,147 @@
+import itertools
+import os
+import threading
+import weakref
+
+instances = weakref.WeakSet()
+
+
+class Instance:
+    # Native Inigo instance of a middleware. It belongs to the process that created it, when the
+    # middleware is created before a fork (gunicorn --preload, uWSGI master) the child transparently
+    # creates its own on first use, or right away through post_fork().
+    def __init__(self, backend, config):
+        self.backend = backend
+        # kept to create the instance again in forked children
+        self.config = config
+
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.id = backend.create(config)
+
+        instances.add(self)
+
+    def __int__(self):
+        if self.pid != os.getpid():
+            self.post_fork()
+        return self.id
+
+    def __bool__(self):
+        return self.id != 0
+
+    def update_schema(self, schema):
+        # Swaps the schema (a schema.SDL) of the running instance. Requests in flight finish with the
+        # one they started with, the config is updated too so forked children get the new schema.
+        if self.pid != os.getpid():
+            self.post_fork()
+
+        with self.lock:
+            if not self.backend.update_schema(self.id, schema.value):
+                return False
+
+            self.config.schema = schema.value
+            # the config only holds a pointer, keeps a mapped schema alive
+            self.schema = schema
+
+        return True
+
+    def post_fork(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.id = self.backend.create(self.config)
+            self.pid = os.getpid()
+
+        if self.id == 0:
+            print("INIGO: error, instance can not be created after fork")
+
+
+class InstancePool:
+    # Opt-in pool of native instances (INIGO 'INSTANCES'), for threaded servers where a single
+    # instance would serialize the native calls. Query checks out a member and keeps its id for the
+    # whole request, process_response always runs on the instance that processed the request.
+    #   'thread'     - every thread sticks to one member, assigned round robin (default)
+    #   'least_busy' - the member with the fewest native calls in flight
+    CHECKOUTS = ('thread', 'least_busy')
+
+    def __init__(self, backend, config, size, checkout='thread'):
+        if checkout not in self.CHECKOUTS:
+            raise ValueError(f"unknown instance checkout '{ checkout }', expected one of { ', '.join(self.CHECKOUTS) }")
+
+        self.config = config
+        self.members = [Instance(backend, config) for _ in range(max(int(size), 1))]
+        self.checkout_mode = checkout
+
+        # native calls in flight per member, only counted for 'least_busy'
+        self.busy = [0] * len(self.members)
+        self.lock = threading.Lock()
+
+        self.local = threading.local()
+        self.next = itertools.count()
+
+        instances.add(self)
+
+    def __bool__(self):
+        return all(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __int__(self):
+        return int(self.members[self.checkout()])
+
+    def checkout(self):
+        # index of the member serving the next request
+        if self.checkout_mode == 'least_busy':
+            busy = self.busy
+            return busy.index(min(busy))
+
+        index = getattr(self.local, 'index', None)
+        if index is None:
+            index = self.local.index = next(self.next) % len(self.members)
+        return index
+
+    def acquire(self, index):
+        if self.checkout_mode == 'least_busy':
+            with self.lock:
+                self.busy[index] += 1
+
+    def release(self, index):
+        if self.checkout_mode == 'least_busy':
+            with self.lock:
+                self.busy[index] -= 1
+
+    def update_schema(self, schema):
+        # every member gets the new schema, False if any of them rejected it
+        return all([member.update_schema(schema) for member in self.members])
+
+    def post_fork(self):
+        for member in self.members:
+            member.post_fork()
+
+
+def new_instance(backend, config, settings=None):
+    # Instance, or an InstancePool when INIGO 'INSTANCES' is a size above 1 or {'SIZE': n, 'CHECKOUT': mode}
+    if isinstance(settings, dict):
+        size, checkout = settings.get('SIZE', 1), settings.get('CHECKOUT', 'thread')
+    else:
+        size, checkout = settings or 1, 'thread'
+
+    if int(size) <= 1:
+        return Instance(backend, config)
+
+    return InstancePool(backend, config, size, checkout)
+
+
+def reset_locks():
+    # a lock held by another thread at fork time stays locked forever in the child
+    for instance in list(instances):
+        instance.lock = threading.Lock()
+        if isinstance(instance, InstancePool):
+            # calls in flight in other threads never complete in the child
+            instance.busy = [0] * len(instance.members)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_locks)
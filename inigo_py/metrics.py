@@ -0,0 +1,109 @@
+from array import array
+from bisect import bisect_left
+
+from . import ffi
+from .utils import fork_safe_lock
+
+# histogram bucket upper bounds in seconds, powers of 2 from 1us up to ~67s
+BOUNDS = tuple(1e-6 * 2 ** i for i in range(27))
+
+
+class Histogram:
+    # fixed buckets, counts kept in a flat array so observing is a bisect and an increment
+    def __init__(self):
+        self.counts = array('Q', [0] * (len(BOUNDS) + 1))
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # upper bound of the bucket the quantile falls in
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BOUNDS[i] if i < len(BOUNDS) else float('inf')
+
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': [(bound, count) for bound, count in zip(BOUNDS + (float('inf'),), self.counts) if count],
+        }
+
+
+class Metrics:
+    # Per-phase latency and size metrics of the middleware hot path.
+    #   total    - whole middleware call
+    #   request  - ffi.process_request
+    #   app      - wrapped application
+    #   response - ffi.process_response
+    #   python   - middleware own time (json, headers, rewrites): total - request - app - response
+    PHASES = ('total', 'request', 'app', 'response', 'python')
+    COUNTERS = ('requests', 'blocked', 'rewritten', 'passthrough', 'cached', 'bytes_in', 'bytes_out')
+
+    def __init__(self):
+        self.lock = fork_safe_lock(self)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {phase: Histogram() for phase in self.PHASES}
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+
+    def observe(self, q, decision, total, app=0.0):
+        request = q.request_duration
+        response = q.response_duration
+
+        with self.lock:
+            self.histograms['total'].observe(total)
+            self.histograms['request'].observe(request)
+            self.histograms['app'].observe(app)
+            self.histograms['response'].observe(response)
+            self.histograms['python'].observe(max(total - request - app - response, 0.0))
+
+            self.counters['requests'] += 1
+            if decision.is_blocked:
+                self.counters['blocked'] += 1
+            elif decision.is_rewritten:
+                self.counters['rewritten'] += 1
+            else:
+                self.counters['passthrough'] += 1
+
+            if q.cached:
+                self.counters['cached'] += 1
+
+            self.counters['bytes_in'] += q.bytes_in
+            self.counters['bytes_out'] += q.bytes_out
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'latency': {phase: histogram.snapshot() for phase, histogram in self.histograms.items()},
+                # process wide, shared by all middlewares
+                'native': ffi.accounting.snapshot(),
+            }
+
+
+def server_timing(q, total, app=0.0):
+    # Server-Timing header value, durations in milliseconds
+    return (
+        f'inigo-request;dur={ q.request_duration * 1000:.3f}, '
+        f'app;dur={ app * 1000:.3f}, '
+        f'inigo-response;dur={ q.response_duration * 1000:.3f}, '
+        f'inigo;dur={ (total - app) * 1000:.3f}'
+    )
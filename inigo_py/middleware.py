@@ -0,0 +1,209 @@
+import platform
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from inigo_py import ffi
+from inigo_py.apq import PersistedQueries
+from inigo_py.breaker import CircuitBreaker
+from inigo_py.cache import DecisionCache, IntrospectionCache
+from inigo_py.codec import get_codec
+from inigo_py.encoding import ContentEncodings
+from inigo_py.headers import HeaderEncoder
+from inigo_py.instance import new_instance
+from inigo_py.metrics import Metrics, server_timing
+from inigo_py.query import graphql_response
+from inigo_py.sampling import ResponseSampler
+from inigo_py.schema import SchemaWatcher, as_sdl, load_schema
+
+class BaseMiddleware:
+    # settings and Inigo calls shared by the framework middlewares, which only add the request and
+    # response plumbing. 'debug' and 'graphene_schema' are the framework DEBUG and GRAPHENE 'SCHEMA'
+    # settings, 'async_mode' runs the ffi calls on the executor.
+    def __init__(self, inigo_settings, name, debug=None, graphene_schema=None, async_mode=False):
+        self.instance = 0
+
+        # default values
+        self.path = '/graphql'
+
+        c = ffi.Config()
+        c.disable_response_data = False
+        c.name = str.encode('inigo-py : ' + name)
+        c.runtime = str.encode('python' + re.search(r'\d+\.\d+', platform.sys.version).group(0))
+
+        inigo_settings = inigo_settings or {}
+
+        if inigo_settings.get('ENABLE') is False:
+            return
+
+        # binding to the Inigo library, INIGO 'BACKEND' can swap it (e.g. for the in-process fake)
+        self.backend = ffi.get_backend(inigo_settings)
+        if self.backend is None:
+            # library is not found, skip middleware initialization
+            return
+
+        # process Inigo settings
+        if inigo_settings.get('DEBUG'):
+            c.debug = inigo_settings.get('DEBUG')
+        elif debug is not None:
+            # use regular DEBUG setting if specific is not provided
+            c.debug = debug
+
+        if inigo_settings.get('TOKEN'):
+            c.token = str.encode(inigo_settings.get('TOKEN'))
+
+        # analytics are sent without the response data
+        if inigo_settings.get('DISABLE_RESPONSE_DATA'):
+            c.disable_response_data = True
+
+        # rendered SDL, or a mapping of the INIGO 'SCHEMA_CACHE' file shared by the workers
+        self.schema = load_schema(inigo_settings, graphene_schema)
+        if self.schema is not None:
+            c.schema = self.schema.value
+
+        if inigo_settings.get('PATH'):
+            self.path = inigo_settings.get('PATH')
+
+        # json encoder/decoder used on the request path, fastest installed one by default
+        self.codec = get_codec(inigo_settings.get('JSON_BACKEND'))
+
+        # headers forwarded to Inigo, allow/deny lists are compiled once here
+        self.header_encoder = HeaderEncoder(inigo_settings.get('HEADERS'), self.codec)
+
+        # opt-in memoization of blocked/rewritten decisions
+        self.cache = None
+        if inigo_settings.get('DECISION_CACHE'):
+            self.cache = DecisionCache(inigo_settings.get('DECISION_CACHE'))
+
+        # opt-in cache of the serialized introspection answers, per schema version
+        self.introspection_cache = None
+        if inigo_settings.get('INTROSPECTION_CACHE'):
+            self.introspection_cache = IntrospectionCache(inigo_settings.get('INTROSPECTION_CACHE'))
+
+        # opt-in automatic persisted queries
+        self.apq = None
+        if inigo_settings.get('APQ'):
+            self.apq = PersistedQueries(inigo_settings.get('APQ'))
+
+        # compressed responses are decoded for Inigo, and encoded again only when modified
+        self.encodings = ContentEncodings(inigo_settings.get('COMPRESSION'))
+
+        # opt-in sampling of the responses processed by Inigo
+        self.sampler = None
+        if inigo_settings.get('RESPONSE_SAMPLING'):
+            self.sampler = ResponseSampler(inigo_settings.get('RESPONSE_SAMPLING'), self.codec)
+
+        # per-phase latency and size metrics, pulled with middleware.metrics.snapshot()
+        self.metrics = None
+        if inigo_settings.get('METRICS', True):
+            self.metrics = Metrics()
+
+        self.server_timing = bool(inigo_settings.get('SERVER_TIMING'))
+
+        # opt-in latency budget, Inigo is bypassed when the library is slow or failing
+        self.breaker = None
+        if inigo_settings.get('LATENCY_BUDGET'):
+            self.breaker = CircuitBreaker(inigo_settings.get('LATENCY_BUDGET'))
+
+        self.executor = None
+        if async_mode or (self.breaker is not None and self.breaker.deadline is not None):
+            # ffi calls block, they are run on a bounded pool so the event loop is never stalled,
+            # and calls with a deadline are waited on from it
+            self.executor = ThreadPoolExecutor(max_workers=inigo_settings.get('MAX_WORKERS'), thread_name_prefix='inigo')
+
+        # create Inigo instance, or a pool of them with INIGO 'INSTANCES'
+        self.instance = new_instance(self.backend, c, inigo_settings.get('INSTANCES'))
+
+        error = self.backend.check_lasterror()
+        if error:
+            print("INIGO: " + error.decode('utf-8'))
+
+        if not self.instance:
+            print("INIGO: error, instance can not be created")
+
+        # opt-in reload of the SCHEMA_PATH file when it changes
+        self.schema_watcher = None
+        watch = inigo_settings.get('SCHEMA_WATCH')
+        if watch and self.instance and inigo_settings.get('SCHEMA_PATH') and not inigo_settings.get('GRAPHENE_SCHEMA'):
+            watch = watch if isinstance(watch, dict) else {}
+            self.schema_watcher = SchemaWatcher(inigo_settings.get('SCHEMA_PATH'), self.update_schema,
+                                                watch.get('INTERVAL', 1.0), watch.get('DEBOUNCE', 0.5))
+            self.schema_watcher.start()
+
+    def process_request(self, q, headers, identity):
+        # decision of Inigo, None when the request bypasses it (LATENCY_BUDGET)
+        if self.breaker is None:
+            return q.process_request(headers, identity)
+        return self.breaker.process_request(q, headers, identity, self.executor)
+
+    async def process_request_async(self, q, headers, identity):
+        # decision of Inigo, None when the request bypasses it (LATENCY_BUDGET)
+        if self.breaker is None:
+            return await q.process_request_async(headers, self.executor, identity)
+        return await self.breaker.process_request_async(q, headers, identity, self.executor)
+
+    def post_fork(self):
+        # creates the native instance of this process right away, to be called from the server
+        # post fork hook (e.g. gunicorn post_fork) instead of waiting for the first request
+        if self.instance:
+            self.instance.post_fork()
+
+    def update_schema(self, schema):
+        # replaces the schema of the running instance without a restart, schema is SDL text (str or
+        # bytes), a Graphene schema or an inigo_py.schema.SDL; returns whether Inigo accepted it
+        if not self.instance:
+            return False
+
+        schema = as_sdl(schema)
+        if not self.instance.update_schema(schema):
+            print("INIGO: error, schema can not be updated")
+            return False
+
+        self.schema = schema
+
+        # cached decisions were made against the previous schema
+        for cache in (self.cache, self.introspection_cache):
+            if cache is not None:
+                cache.clear()
+
+        return True
+
+    def observe(self, q, decision, start, app=0.0):
+        # records the request metrics, returns the Server-Timing header value when enabled
+        total = time.perf_counter() - start
+
+        if self.metrics is not None:
+            self.metrics.observe(q, decision, total, app)
+
+        if self.server_timing:
+            return server_timing(q, total, app)
+
+        return None
+
+    def sampled(self, q, decision, size=None):
+        # responses left out of RESPONSE_SAMPLING skip process_response, the decision is still recorded
+        return self.sampler is None or self.sampler.sample(q, decision, size)
+
+    def select_cache(self, request):
+        # introspection queries are cached on their own, per schema version
+        if self.introspection_cache is not None and self.introspection_cache.matches(request):
+            return self.introspection_cache
+        return self.cache
+
+    def identity(self, environ, cache):
+        if cache is None:
+            return ()
+        return cache.identity_environ(environ)
+
+    def headers(self, environ):
+        return self.header_encoder.from_environ(environ)
+
+    def response_body(self, data):
+        if isinstance(data, bytes):
+            # already serialized, see Decision.body
+            return data
+        if isinstance(data, list):
+            # every operation of a batch is answered by Inigo
+            return self.codec.dumps(data)
+        return self.codec.dumps(graphql_response(data))
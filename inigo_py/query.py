@@ -1,62 +1,209 @@
-import ctypes
+import asyncio
+import re
+import time
 from . import ffi
-import json
+from .codec import get_codec
+from .instance import InstancePool
+
+# native output which already is a GraphQL response, the library writes compact json starting with data or errors
+GRAPHQL_RESPONSE_RE = re.compile(rb'\s*\{\s*"(?:data|errors)"\s*:')
 
 
 class Query:
-    def __init__(self, instance, request):
+    def __init__(self, instance, request, codec=None, cache=None, backend=None):
         self.handle = 0
-        self.instance = instance
-
-        self.request = request
-
-    def process_request(self, headers):
-        resp_input = ctypes.create_string_buffer(self.request)
-
-        output_ptr = ctypes.c_char_p()
-        output_len = ctypes.c_int()
-
-        status_ptr = ctypes.c_char_p()
-        status_len = ctypes.c_int()
 
-        self.handle = ffi.process_request(self.instance,
-                                          ctypes.create_string_buffer(headers), len(headers),
-                                          resp_input, len(self.request),
-                                          ctypes.byref(output_ptr), ctypes.byref(output_len),
-                                          ctypes.byref(status_ptr), ctypes.byref(status_len))
+        # a pool member is checked out for the whole query, the response is processed by the
+        # native instance which processed the request
+        self.pool = None
+        self.slot = 0
+        if isinstance(instance, InstancePool):
+            self.pool = instance
+            # checked out by process_request, see checkout()
+            self.instance = 0
+        else:
+            # an Instance resolves to the instance id of the current process
+            self.instance = int(instance)
+        self.backend = backend or ffi.load()
 
-        resp_dict = {}
-        req_dict = {}
-
-        if output_len.value:
-            resp_dict = json.loads(output_ptr.value[:output_len.value].decode("utf-8"))
-
-        if status_len.value:
-            req_dict = json.loads(status_ptr.value[:status_len.value].decode("utf-8"))
-
-        ffi.disposeMemory(ctypes.cast(output_ptr, ctypes.c_void_p))
-        ffi.disposeMemory(ctypes.cast(status_ptr, ctypes.c_void_p))
+        self.request = request
 
-        return resp_dict, req_dict
+        self.codec = codec or get_codec()
+        self.cache = cache
+
+        # set when the handle is owned by a call still running in the background, see detach()
+        self.detached = False
+
+        # measurements of the native calls, collected by the middleware metrics
+        self.cached = False
+        self.request_duration = 0.0
+        self.response_duration = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def process_request(self, headers, identity=()):
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(self.request, identity)
+            # decisions made before the cache was cleared (schema update) are not stored
+            generation = self.cache.generation
+            decision = self.cache.get(key)
+            if decision is not None:
+                # served without a native call, there is no handle and the response is not processed
+                self.cached = True
+                return decision
+
+        if self.pool is not None:
+            self.checkout()
+            self.pool.acquire(self.slot)
+
+        start = time.perf_counter()
+        try:
+            self.handle, output, status = self.backend.process_request(self.instance, headers, self.request)
+        finally:
+            self.request_duration = time.perf_counter() - start
+            if self.pool is not None:
+                self.pool.release(self.slot)
+
+        if self.handle != 0:
+            ffi.accounting.acquire('handles')
+
+        self.bytes_in += len(headers) + len(self.request)
+        self.bytes_out += len(output) + len(status)
+
+        decision = Decision(output, status, self.codec)
+
+        if key is not None and self.cache.cacheable(decision):
+            self.cache.put(key, decision, generation)
+
+        return decision
+
+    def checkout(self):
+        # the member is picked in the thread making the native call: the async middlewares create
+        # queries on the event loop thread, 'thread' checkout there would pin every request to one member
+        self.slot = self.pool.checkout()
+        self.instance = int(self.pool.members[self.slot])
 
     def process_response(self, resp_body):
         if self.handle == 0:
             return None
 
-        output_ptr = ctypes.c_char_p()
-        output_len = ctypes.c_int()
+        if self.pool is not None:
+            self.pool.acquire(self.slot)
 
-        ffi.process_response(
-            self.instance,
-            self.handle,
-            resp_body, len(resp_body),
-            ctypes.byref(output_ptr), ctypes.byref(output_len)
-        )
+        start = time.perf_counter()
+        try:
+            output = self.backend.process_response(self.instance, self.handle, resp_body)
+        finally:
+            self.response_duration = time.perf_counter() - start
+            if self.pool is not None:
+                self.pool.release(self.slot)
+            # the handle is released even when the native call failed
+            self.dispose()
 
-        if output_len.value:
-            resp_body = output_ptr.value[:output_len.value][:]
+        self.bytes_in += len(resp_body)
 
-        ffi.disposeMemory(ctypes.cast(output_ptr, ctypes.c_void_p))
-        ffi.disposeHandle(self.handle)
+        if output is not None:
+            self.bytes_out += len(output)
+            resp_body = output
 
         return resp_body
+
+    def dispose(self):
+        # releases the request handle when the response is not sent through process_response
+        if self.handle != 0:
+            handle, self.handle = self.handle, 0
+            self.backend.dispose_handle(handle)
+            ffi.accounting.release('handles')
+
+    def detach(self):
+        # the request stopped waiting for process_request (LATENCY_BUDGET deadline), the handle is
+        # released by the callback of the running call only, never by the request thread as well
+        self.detached = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # 'with Query(...) as q' releases the handle on every path: blocked, passed through,
+        # skipped response processing, or the app raising
+        if not self.detached:
+            self.dispose()
+
+    async def process_request_async(self, headers, executor=None, identity=()):
+        # ffi calls are blocking, run them off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_request, headers, identity)
+
+    async def process_response_async(self, resp_body, executor=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_response, resp_body)
+
+
+class Decision:
+    # Outcome of process_request. Keeps the raw native output and only parses it when read,
+    # requests passing through untouched never pay for json decoding.
+    __slots__ = ('raw_response', 'raw_request', 'codec', '_response', '_request', '_body')
+
+    def __init__(self, raw_response, raw_request, codec):
+        self.raw_response = raw_response
+        self.raw_request = raw_request
+        self.codec = codec
+
+        self._response = None
+        self._request = None
+        self._body = None
+
+    @property
+    def is_blocked(self):
+        # request is answered by Inigo (blocked or introspection query), response holds the reply
+        return bool(self.raw_response)
+
+    @property
+    def is_rewritten(self):
+        # query was modified by Inigo, request holds the new query, operationName and variables
+        return bool(self.raw_request)
+
+    @property
+    def response(self):
+        if self._response is None:
+            self._response = self.codec.loads(self.raw_response) if self.raw_response else {}
+        return self._response
+
+    @property
+    def request(self):
+        if self._request is None:
+            self._request = self.codec.loads(self.raw_request) if self.raw_request else {}
+        return self._request
+
+    def body(self):
+        # serialized GraphQL response of a blocked/introspection decision. The native output is sent as
+        # is when it already is a GraphQL response, otherwise it is normalized once; either way cached
+        # decisions are served without any json work.
+        if self._body is None:
+            if GRAPHQL_RESPONSE_RE.match(self.raw_response):
+                self._body = bytes(self.raw_response)
+            else:
+                self._body = self.codec.dumps(graphql_response(self.response))
+        return self._body
+
+    def __iter__(self):
+        # backwards compatible 'resp, req = q.process_request(...)' unpacking
+        yield self.response
+        yield self.request
+
+
+def graphql_response(data):
+    # GraphQL response out of a blocked/introspection decision
+    response = {
+        'data': data.get('data'),
+    }
+
+    if data.get('errors'):
+        response['errors'] = data.get('errors')
+
+    if data.get('extensions'):
+        response['extensions'] = data.get('extensions')
+
+    return response
+
@@ -0,0 +1,91 @@
+import random
+
+from . import ffi
+from .utils import fork_safe_lock
+
+
+class ResponseSampler:
+    # Picks the responses which go through process_response (response analytics), opt-in with
+    # INIGO 'RESPONSE_SAMPLING':
+    #   RATE       - share of responses processed (0..1), 1 by default
+    #   OPERATIONS - rate per operationName, e.g. {'IntrospectionQuery': 0, 'Checkout': 1}, overrides RATE
+    #   ADAPTIVE   - True or {'MAX_SIZE': 262144, 'MAX_IN_FLIGHT': 64, 'MIN_RATE': 0.01}: the rate is
+    #                lowered in proportion for responses above MAX_SIZE bytes and while more than
+    #                MAX_IN_FLIGHT requests are being processed, down to MIN_RATE
+    #
+    # Every request still goes through process_request, blocked and rewritten decisions apply and
+    # are recorded. Left out responses skip process_response, except for rewritten requests which
+    # are always processed.
+    def __init__(self, settings=None, codec=None):
+        if not isinstance(settings, dict):
+            settings = {}
+
+        self.rate = settings.get('RATE', 1.0)
+        self.operations = settings.get('OPERATIONS') or {}
+        self.codec = codec
+
+        adaptive = settings.get('ADAPTIVE')
+        self.adaptive = bool(adaptive)
+        adaptive = adaptive if isinstance(adaptive, dict) else {}
+        self.max_size = adaptive.get('MAX_SIZE', 256 * 1024)
+        self.max_in_flight = adaptive.get('MAX_IN_FLIGHT', 64)
+        self.min_rate = adaptive.get('MIN_RATE', 0.01)
+
+        self.random = random.Random()
+        self.lock = fork_safe_lock(self)
+
+        self.sampled = 0
+        self.skipped = 0
+
+    def operation_name(self, q):
+        # only decoded when per operation rates are configured, batches have no single name
+        try:
+            payload = self.codec.loads(q.request)
+        except ValueError:
+            return None
+        if isinstance(payload, dict):
+            return payload.get('operationName')
+        return None
+
+    def rate_for(self, q, size=None):
+        rate = self.rate
+        if self.operations:
+            rate = self.operations.get(self.operation_name(q), rate)
+
+        if self.adaptive and rate > 0:
+            floor = min(self.min_rate, rate)
+
+            if size and size > self.max_size:
+                rate *= self.max_size / size
+
+            # requests holding a native handle, i.e. in flight in the process
+            in_flight = ffi.accounting.live['handles']
+            if in_flight > self.max_in_flight:
+                rate *= self.max_in_flight / in_flight
+
+            rate = max(rate, floor)
+
+        return rate
+
+    def sample(self, q, decision, size=None):
+        # size of the response in bytes, when known
+        if decision.is_rewritten:
+            sampled = True
+        else:
+            rate = self.rate_for(q, size)
+            sampled = rate >= 1 or (rate > 0 and self.random.random() < rate)
+
+        with self.lock:
+            if sampled:
+                self.sampled += 1
+            else:
+                self.skipped += 1
+
+        return sampled
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sampled': self.sampled,
+                'skipped': self.skipped,
+            }
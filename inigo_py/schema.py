@@ -0,0 +1,328 @@
+import ctypes
+import hashlib
+import importlib.util
+import mmap
+import os
+import site
+import sys
+import sysconfig
+import threading
+import weakref
+
+from .utils import import_string, write_atomic
+
+# bumped when the layout of the cache files changes
+CACHE_FORMAT = b'2'
+
+
+class SDL:
+    # Schema handed to the library through Config.schema. Either bytes, or a copy-on-write mapping
+    # of a cache file: nothing is rendered or copied and the pages are shared by the workers of a host.
+    def __init__(self, data=None, mapping=None):
+        self.data = data
+        self.mapping = mapping
+
+        if mapping is not None:
+            # cache files end with a NUL, the mapping is a valid C string
+            self.value = ctypes.addressof(ctypes.c_char.from_buffer(mapping))
+        else:
+            self.value = data
+
+    def __bytes__(self):
+        if self.mapping is not None:
+            return self.mapping[:len(self.mapping) - 1]
+        return self.data
+
+    def __len__(self):
+        if self.mapping is not None:
+            return len(self.mapping) - 1
+        return len(self.data)
+
+
+def load_schema(settings, graphene_schema=None):
+    # SDL of the configured schema: INIGO 'GRAPHENE_SCHEMA', 'SCHEMA_PATH', then the framework
+    # GRAPHENE 'SCHEMA' setting. Graphene schemas are read from INIGO 'SCHEMA_CACHE' when it is set.
+    dotted_path = None
+    if settings.get('GRAPHENE_SCHEMA'):
+        dotted_path = settings.get('GRAPHENE_SCHEMA')
+    elif settings.get('SCHEMA_PATH'):
+        if os.path.isfile(settings.get('SCHEMA_PATH')):
+            with open(settings.get('SCHEMA_PATH'), 'rb') as f:
+                data = f.read()
+            if data:
+                return SDL(data)
+        return None
+    elif graphene_schema:
+        dotted_path = graphene_schema
+
+    if not dotted_path:
+        return None
+
+    cache_dir = settings.get('SCHEMA_CACHE')
+    if not cache_dir:
+        data = render(dotted_path)
+        return SDL(data) if data else None
+
+    path = cache_path(cache_dir, dotted_path)
+    if path is not None and os.path.isfile(path):
+        return open_cached(path)
+
+    data = render(dotted_path)
+    if not data:
+        return None
+
+    try:
+        write_cache(cache_dir, dotted_path, data)
+    except OSError as err:
+        # read-only deployments still work, every worker renders the schema
+        print(f"INIGO: schema cache { cache_dir } can not be written: { err }")
+
+    return SDL(data)
+
+
+def render(dotted_path):
+    schema = import_string(dotted_path)
+    return str(schema).encode('utf-8')
+
+
+def fingerprint(dotted_path, modules=()):
+    # Content hash of the sources a schema is built from: every python file of its top level
+    # package (or the module itself), the project modules loaded along with it (types imported from
+    # sibling packages), the graphene version and the cache format. File contents are hashed rather
+    # than mtimes, so a cache built in CI stays valid when copied into an image. None when one of
+    # the modules is gone.
+    h = hashlib.sha256()
+    h.update(CACHE_FORMAT + b'\0' + dotted_path.encode('utf-8') + b'\0')
+
+    try:
+        from importlib.metadata import version
+        h.update(version('graphene').encode('utf-8') + b'\0')
+    except Exception:
+        pass
+
+    files = dict(sources(dotted_path))
+    for name in modules:
+        if name not in files:
+            path = locate(name)
+            if path is None:
+                return None
+            files[name] = path
+
+    for name, path in sorted(files.items()):
+        h.update(name.encode('utf-8') + b'\0')
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+
+    return h.hexdigest()
+
+
+def sources(dotted_path):
+    # (name, path) of the python files of the package defining dotted_path, sorted. Names are
+    # relative to the sys.path entry, e.g. 'myapp/schema.py', like project_modules()
+    top = dotted_path.split('.', 1)[0]
+    spec = importlib.util.find_spec(top)
+    if spec is None:
+        return []
+
+    if not spec.submodule_search_locations:
+        if spec.origin and os.path.isfile(spec.origin):
+            return [(os.path.basename(spec.origin), spec.origin)]
+        return []
+
+    result = []
+    for location in spec.submodule_search_locations:
+        for root, dirs, files in os.walk(location):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.startswith('.'))
+            for name in files:
+                if name.endswith('.py'):
+                    path = os.path.join(root, name)
+                    result.append((os.path.relpath(path, os.path.dirname(location)), path))
+
+    return sorted(result)
+
+
+def project_modules():
+    # names of the loaded python modules outside of the standard library and installed packages,
+    # relative to their sys.path entry: the ones a schema rendered in this process may come from
+    libraries = library_paths()
+    entries = sorted(set(os.path.abspath(entry) for entry in sys.path), key=len, reverse=True)
+
+    result = set()
+    for name, module in list(sys.modules.items()):
+        # the entry script differs between the build and the workers
+        if name == '__main__':
+            continue
+
+        path = getattr(module, '__file__', None)
+        if not path or not path.endswith('.py'):
+            continue
+
+        path = os.path.abspath(path)
+        if any(path.startswith(library + os.sep) for library in libraries):
+            continue
+
+        for entry in entries:
+            if path.startswith(entry + os.sep):
+                result.add(os.path.relpath(path, entry))
+                break
+
+    return sorted(result)
+
+
+def library_paths():
+    paths = set(sysconfig.get_paths().get(key) for key in ('stdlib', 'platstdlib', 'purelib', 'platlib'))
+    try:
+        paths.update(site.getsitepackages())
+        paths.add(site.getusersitepackages())
+    except AttributeError:
+        # old virtualenv site modules
+        pass
+    return [os.path.abspath(path) for path in paths if path]
+
+
+def locate(name):
+    # path of a project_modules() name, looked up on sys.path without importing anything
+    for entry in sys.path:
+        path = os.path.join(os.path.abspath(entry), name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def manifest_path(cache_dir, dotted_path):
+    # modules loaded when the schema was last rendered into cache_dir, one name per line
+    return os.path.join(cache_dir, hashlib.sha256(dotted_path.encode('utf-8')).hexdigest() + '.sources')
+
+
+def cache_path(cache_dir, dotted_path, modules=None):
+    # cache file of the schema, None when the schema was never rendered into cache_dir or its
+    # sources are gone. modules default to the manifest of the last render.
+    if modules is None:
+        try:
+            with open(manifest_path(cache_dir, dotted_path), 'rb') as f:
+                modules = f.read().decode('utf-8').split('\n')
+        except (OSError, UnicodeDecodeError):
+            return None
+
+    digest = fingerprint(dotted_path, [name for name in modules if name])
+    if digest is None:
+        return None
+
+    return os.path.join(cache_dir, digest + '.graphql')
+
+
+def write_cache(cache_dir, dotted_path, data):
+    # called right after rendering, the modules loaded by then are the ones the schema is built from
+    modules = project_modules()
+    path = cache_path(cache_dir, dotted_path, modules)
+
+    # the cache file first, a worker reading the new manifest always finds it
+    write_cached(path, data)
+    write_atomic(manifest_path(cache_dir, dotted_path), '\n'.join(modules).encode('utf-8'))
+    return path
+
+
+def write_cached(path, data):
+    # NUL terminated, the mapping of the file is used as a C string
+    write_atomic(path, data + b'\0')
+
+
+def open_cached(path):
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    if len(mapping) < 2 or mapping[-1:] != b'\0':
+        mapping.close()
+        return None
+
+    return SDL(mapping=mapping)
+
+
+def build(dotted_path, cache_dir):
+    # renders the schema into cache_dir ahead of time, returns the cache file path
+    return write_cache(cache_dir, dotted_path, render(dotted_path))
+
+
+def as_sdl(schema):
+    # SDL out of an SDL, its text (str or bytes) or a Graphene schema
+    if isinstance(schema, SDL):
+        return schema
+    if isinstance(schema, bytes):
+        return SDL(schema)
+    return SDL(str(schema).encode('utf-8'))
+
+
+watchers = weakref.WeakSet()
+
+
+class SchemaWatcher:
+    # Polls a SCHEMA_PATH file and calls update(SDL) when it changes. A change is applied once the
+    # file has stayed the same for 'debounce' seconds, so an editor or a deploy writing it in several
+    # steps results in a single update of the full file.
+    def __init__(self, path, update, interval=1.0, debounce=0.5):
+        self.path = path
+        self.update = update
+        self.interval = interval
+        self.debounce = debounce
+
+        self.stat = self.stat_file()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        watchers.add(self)
+
+    def stat_file(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='inigo-schema-watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as err:
+                print(f"INIGO: schema { self.path } can not be reloaded: { err }")
+
+    def check(self):
+        stat = self.stat_file()
+        if stat is None or stat == self.stat:
+            return
+
+        # wait for the writes to settle
+        while not self.stopped.wait(self.debounce):
+            current = self.stat_file()
+            if current == stat:
+                break
+            stat = current
+            if stat is None:
+                return
+        else:
+            return
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        self.stat = stat
+        if data:
+            self.update(SDL(data))
+
+
+def restart_watchers():
+    # threads do not survive a fork, watchers started before it run again in the child
+    for watcher in list(watchers):
+        if watcher.thread is not None and not watcher.stopped.is_set():
+            watcher.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_watchers)
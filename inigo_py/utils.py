@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import threading
+import weakref
+
+from importlib import import_module
+from urllib.parse import quote_plus, unquote_plus
+
+
+def cached_import(module_path, class_name):
+    # Check whether module is loaded and fully initialized.
+    if not (
+            (module := sys.modules.get(module_path))
+            and (spec := getattr(module, "__spec__", None))
+            and getattr(spec, "_initializing", False) is False
+    ):
+        module = import_module(module_path)
+    return getattr(module, class_name)
+
+
+def import_string(dotted_path):
+    """
+    Import a dotted module path and return the attribute/class designated by the
+    last name in the path. Raise ImportError if the import failed.
+    """
+    try:
+        module_path, class_name = dotted_path.rsplit(".", 1)
+    except ValueError as err:
+        raise ImportError("%s doesn't look like a module path" % dotted_path) from err
+
+    try:
+        return cached_import(module_path, class_name)
+    except AttributeError as err:
+        raise ImportError(
+            'Module "%s" does not define a "%s" attribute/class'
+            % (module_path, class_name)
+        ) from err
+
+
+def replace_query_param(query_string, name, value):
+    # Splices a single parameter into a url query string, other parameters are kept byte for byte.
+    pair = f"{ name }={ quote_plus(value or '') }"
+
+    params = query_string.split('&') if query_string else []
+    for i, param in enumerate(params):
+        if unquote_plus(param.split('=', 1)[0]) == name:
+            params[i] = pair
+            break
+    else:
+        params.append(pair)
+
+    return '&'.join(params)
+
+
+def write_atomic(path, data):
+    # Written next to the target and renamed, concurrent readers never see a partial file.
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+# objects whose 'lock' attribute is re-created in forked children
+lock_owners = weakref.WeakSet()
+
+
+def fork_safe_lock(owner):
+    # lock to be stored as owner.lock. A lock held by another thread at fork time (e.g. the schema
+    # watcher clearing a cache in a --preload master) stays locked forever in the child, it is
+    # replaced there.
+    lock_owners.add(owner)
+    return threading.Lock()
+
+
+def reset_locks():
+    for owner in list(lock_owners):
+        owner.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_locks)